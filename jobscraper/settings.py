@@ -49,6 +49,20 @@ DATABASES = {
     }
 }
 
+# Optionally use a local Postgres database, e.g. to benchmark against the same
+# database engine as production.
+if os.getenv("LOCAL_PGHOST"):
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.getenv("LOCAL_PGDATABASE", "postgres"),
+            "USER": os.getenv("LOCAL_PGUSER", "postgres"),
+            "PASSWORD": os.getenv("LOCAL_PGPASS", ""),
+            "HOST": os.getenv("LOCAL_PGHOST"),
+            "PORT": os.getenv("LOCAL_PGPORT", "5432"),
+        }
+    }
+
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
 # Upload handling
@@ -82,10 +96,43 @@ DROPBOX_OAUTH2_TOKEN = os.getenv("DROPBOX_OAUTH2_TOKEN", "")
 
 # Seasonal jobs specific URLS
 JOBS_RSS_FEED_URL = "https://seasonaljobs.dol.gov/job_rss.xml"
+# Additional feeds (e.g. per visa class or mirrors) can be added as a comma-separated list.
+JOBS_RSS_FEED_URLS = [JOBS_RSS_FEED_URL] + [
+    url.strip()
+    for url in os.getenv("JOBS_RSS_EXTRA_FEED_URLS", "").split(",")
+    if url.strip()
+]
 JOBS_API_URL = "https://api.seasonaljobs.dol.gov/datahub/search?api-version=2020-06-30"
 JOB_ORDER_BASE_URL = "https://api.seasonaljobs.dol.gov/job-order/"
 JOBS_API_KEY = os.getenv("JOBS_API_KEY", False)
 
+# Listings that fail to scrape are retried after SCRAPE_RETRY_DELAY seconds, doubling
+# with each attempt up to SCRAPE_MAX_RETRY_DELAY, and given up on after
+# SCRAPE_MAX_ATTEMPTS attempts.
+SCRAPE_RETRY_DELAY = int(os.getenv("SCRAPE_RETRY_DELAY", 60 * 60))
+SCRAPE_MAX_RETRY_DELAY = int(os.getenv("SCRAPE_MAX_RETRY_DELAY", 7 * 24 * 60 * 60))
+SCRAPE_MAX_ATTEMPTS = int(os.getenv("SCRAPE_MAX_ATTEMPTS", 8))
+
+# Shared HTTP client used by the scrapers
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", 30))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5))
+HTTP_RETRY_STATUSES = [500, 502, 504]
+# Responses that mean DOL is throttling us. These slow down the shared rate limiter
+# (in requests/second) and are retried once it allows, honouring any Retry-After.
+HTTP_THROTTLE_STATUSES = [429, 503]
+HTTP_RATE_LIMIT = float(os.getenv("HTTP_RATE_LIMIT", 5))
+HTTP_MIN_RATE_LIMIT = float(os.getenv("HTTP_MIN_RATE_LIMIT", 0.2))
+HTTP_MAX_RATE_LIMIT = float(os.getenv("HTTP_MAX_RATE_LIMIT", 20))
+# Optional on-disk cache of datahub searches and job order PDFs, revalidated with
+# ETag/Last-Modified once older than HTTP_CACHE_TTL seconds, and trimmed to
+# HTTP_CACHE_MAX_SIZE bytes by evicting the least recently used responses.
+HTTP_CACHE_ENABLED = os.getenv("HTTP_CACHE_ENABLED", "False") != "False"
+HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", os.path.join(MEDIA_ROOT, "http_cache"))
+HTTP_CACHE_TTL = int(os.getenv("HTTP_CACHE_TTL", 24 * 60 * 60))
+HTTP_CACHE_MAX_SIZE = int(os.getenv("HTTP_CACHE_MAX_SIZE", 500 * 1024 * 1024))
+
 # Rollbar
 ROLLBAR = {
     "access_token": os.getenv("ROLLBAR_ACCESS_TOKEN", ""),
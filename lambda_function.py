@@ -1,6 +1,18 @@
 import os
 import django
 
+# Seconds of Lambda time kept back from commands, for collecting stats and shutdown.
+RESERVED_SECONDS = 10
+# Commands that accept a --deadline, which stop taking new work once they are
+# projected to run out of time.
+DEADLINE_COMMANDS = [
+    "scrape_rss",
+    "scrape_listings",
+    "sync_datahub",
+    "fetch_pdfs",
+    "rescrape_listings",
+]
+
 
 def get_stats():
     django.setup()
@@ -9,10 +21,14 @@ def get_stats():
 
     listing_count = Listing.objects.count()
     listing_unscraped = Listing.objects.filter(scraped=False).count()
+    listing_active = Listing.objects.filter(delisted_at__isnull=True).count()
+    listing_abandoned = Listing.objects.filter(scrape_abandoned=True).count()
 
     return {
         "listings": listing_count,
         "unscraped": listing_unscraped,
+        "active": listing_active,
+        "abandoned": listing_abandoned,
     }
 
 
@@ -32,8 +48,21 @@ def lambda_handler(event, context):
         "scrape_rss",
         "scrape_listings",
         "export_listings",
+        "sync_datahub",
+        "fetch_pdfs",
+        "rescrape_listings",
     ]:
         extra_args = event.get("args", [])
+        if (
+            context is not None
+            and event["command"] in DEADLINE_COMMANDS
+            and not any(arg.startswith("--deadline") for arg in extra_args)
+        ):
+            remaining = context.get_remaining_time_in_millis() / 1000
+            extra_args = extra_args + [
+                "--deadline",
+                str(max(remaining - RESERVED_SECONDS, 0)),
+            ]
         execute_from_command_line(["", event["command"]] + extra_args)
 
     return get_stats()
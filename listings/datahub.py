@@ -0,0 +1,103 @@
+from collections import namedtuple
+
+from django.conf import settings
+
+from listings import http_client
+
+API_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.149 Safari/537.36"
+
+# The API won't return more than this many records per request.
+MAX_TOP = 1000
+
+# Field used to find records that are new or changed since an incremental sync.
+WATERMARK_FIELD = "accepted_date"
+
+# Result of a datahub search. error is None, "status" or "json".
+SearchResult = namedtuple("SearchResult", ["response", "records", "error"])
+
+
+def search(payload, cache=False):
+    """
+    POST a search to the SeasonalJobs datahub API. Safe to call from worker threads.
+    """
+    response = http_client.post(
+        settings.JOBS_API_URL,
+        cache=cache,
+        json=payload,
+        headers={
+            "User-Agent": API_USER_AGENT,
+            "Content-Type": "application/json",
+        },
+    )
+    if response.status_code != 200:
+        return SearchResult(response, [], "status")
+
+    try:
+        records = response.json()["value"]
+    except (ValueError, KeyError):
+        return SearchResult(response, [], "json")
+
+    return SearchResult(response, records, None)
+
+
+def lookup_payload(dol_ids):
+    """
+    Search payload for up to MAX_TOP case numbers, filtered on exact matches so
+    that similar case numbers can't crowd any of them out.
+    """
+    return {
+        "search": "*",
+        "filter": f"search.in(case_number, {odata_string(','.join(dol_ids))}, ',')",
+        "top": len(dol_ids),
+    }
+
+
+def odata_string(value):
+    """
+    Quote a string literal for an OData filter expression.
+    """
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def page_payload(top, after=None, since=None):
+    """
+    Search payload for one page of the whole index, in a stable case number order.
+    If since is given, only records accepted on or after it are returned, oldest
+    first.
+
+    Pages are keyed on the last record of the previous page rather than skipped
+    through, since the API won't skip more than 100000 records.
+    """
+    payload = {
+        "search": "*",
+        "orderby": "case_number asc",
+        "top": top,
+    }
+    if after:
+        payload["filter"] = f"case_number gt {odata_string(after['case_number'])}"
+    if since:
+        payload["orderby"] = f"{WATERMARK_FIELD} asc, case_number asc"
+        payload["filter"] = f"{WATERMARK_FIELD} ge {since}"
+        if after:
+            last = after[WATERMARK_FIELD]
+            payload["filter"] += (
+                f" and ({WATERMARK_FIELD} gt {last} or ({WATERMARK_FIELD} eq {last}"
+                f" and case_number gt {odata_string(after['case_number'])}))"
+            )
+    return payload
+
+
+def lookup(dol_ids):
+    # Cached for no longer than a failed listing waits to be retried, so that a
+    # listing the API missed is looked up afresh.
+    return search(lookup_payload(dol_ids), cache=settings.SCRAPE_RETRY_DELAY)
+
+
+def records_by_case_number(records):
+    """
+    Map records to their case_number, keeping the first record for each.
+    """
+    by_case_number = {}
+    for record in records:
+        by_case_number.setdefault(record.get("case_number"), record)
+    return by_case_number
@@ -0,0 +1,41 @@
+import time
+
+
+def add_deadline_argument(parser):
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        help="Seconds the command has to finish in. No new work is started once it is projected to overrun, defaults to no limit",
+        default=None,
+    )
+
+
+class Deadline:
+    """
+    Time budget for a command run. Projects whether more work will finish in time
+    from the average time taken by the work done so far.
+    """
+
+    def __init__(self, seconds=None):
+        self.started = time.monotonic()
+        self.expires = None if seconds is None else self.started + seconds
+        self.completed = 0
+        self.reached = False
+
+    def done(self, units=1):
+        self.completed += units
+
+    def allows(self, units=1):
+        """
+        Whether units more units of work are projected to finish before the deadline.
+        Once this returns False it always does, so that the run winds down.
+        """
+        if self.expires is None:
+            return True
+        if not self.reached:
+            current = time.monotonic()
+            per_unit = (
+                (current - self.started) / self.completed if self.completed else 0
+            )
+            self.reached = current + per_unit * units >= self.expires
+        return not self.reached
@@ -0,0 +1,222 @@
+from collections import namedtuple
+from hashlib import sha256
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+CHUNK_SIZE = 64 * 1024
+# Headers that describe the body as sent over the wire, rather than as stored.
+DROPPED_HEADERS = ["Content-Encoding", "Content-Length", "Transfer-Encoding"]
+
+# body is the entry's body file, opened while holding the lock so that it stays
+# readable even if another thread evicts the entry.
+CacheEntry = namedtuple(
+    "CacheEntry",
+    ["key", "url", "headers", "etag", "last_modified", "stored_at", "body"],
+)
+
+
+def request_key(method, url, payload=None):
+    """
+    Cache key for a request: its method, URL and (for searches) JSON payload.
+    """
+    content = "\x1f".join(
+        [method.upper(), url, json.dumps(payload, sort_keys=True) if payload else ""]
+    )
+    return sha256(content.encode("utf-8")).hexdigest()
+
+
+class CachedBody:
+    """
+    Body file of a cached response, which closes itself once read to the end, so
+    that responses read through .content or .json() don't leave it open.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, size=-1):
+        if self.body.closed:
+            return b""
+        data = self.body.read(size)
+        if not data:
+            self.body.close()
+        return data
+
+    def close(self):
+        self.body.close()
+
+
+class ResponseCache:
+    """
+    Cache of successful responses on local disk. Bodies are stored as files, with a
+    SQLite index holding their headers, validators and access times. Safe to use
+    from worker threads.
+    """
+
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(
+            os.path.join(directory, "index.sqlite3"), check_same_thread=False
+        )
+        with self.lock, self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    headers TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    size INTEGER NOT NULL,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """)
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+            )
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.body")
+
+    def get(self, key):
+        """
+        Return the CacheEntry for a key, marking it as used, or None. The caller
+        must either build a response from it or close its body.
+        """
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT key, url, headers, etag, last_modified, stored_at FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            try:
+                body = open(self.path(key), "rb")
+            except FileNotFoundError:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self.db.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        return CacheEntry(row[0], row[1], json.loads(row[2]), *row[3:], body)
+
+    def is_fresh(self, entry, ttl=None):
+        return time.time() - entry.stored_at < (self.ttl if ttl is None else ttl)
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def revalidated(self, entry):
+        """
+        Restart an entry's TTL after the server confirmed it is unchanged.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE responses SET stored_at = ? WHERE key = ?",
+                (time.time(), entry.key),
+            )
+
+    def response(self, entry):
+        """
+        Build a response that reads its body from the cache.
+        """
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry.url
+        response.headers = CaseInsensitiveDict(entry.headers)
+        response.raw = CachedBody(entry.body)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    def store(self, key, response):
+        """
+        Stream a response's body into the cache, and return a response that reads it
+        back from there.
+        """
+        headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name not in DROPPED_HEADERS
+        }
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(temp_path, self.path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        finally:
+            response.close()
+
+        stored_at = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    response.url,
+                    json.dumps(headers),
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    size,
+                    stored_at,
+                    stored_at,
+                ),
+            )
+            self.evict(keep=key)
+            body = open(self.path(key), "rb")
+
+        return self.response(
+            CacheEntry(
+                key,
+                response.url,
+                headers,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                stored_at,
+                body,
+            )
+        )
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used responses, other than keep, until the cache fits
+        in max_size. Must be called holding the lock.
+        """
+        total = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, size in self.db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+            total -= size
@@ -0,0 +1,256 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+import time
+
+from django.conf import settings
+
+from listings.http_cache import ResponseCache, request_key
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/42.0.2311.135 Safari/537.36 Edge/12.246"
+
+# On throttling the rate is multiplied by RATE_DECREASE, and each successful
+# request adds RATE_INCREASE to it, up to the configured limits.
+RATE_DECREASE = 0.5
+RATE_INCREASE = 0.1
+
+_session = None
+_session_lock = threading.Lock()
+_rate_limiter = None
+_cache = None
+
+
+def build_session():
+    """
+    Build a requests Session with pooled keep-alive connections and retries, as
+    configured by the HTTP_* settings.
+    """
+    retry = Retry(
+        total=settings.HTTP_MAX_RETRIES,
+        backoff_factor=settings.HTTP_BACKOFF_FACTOR,
+        status_forcelist=settings.HTTP_RETRY_STATUSES,
+        # The datahub search POST is a read, so it is safe to retry too.
+        allowed_methods=frozenset(["HEAD", "GET", "POST"]),
+        respect_retry_after_header=True,
+        # Hand the last response back rather than raising, so callers can report it.
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.HTTP_POOL_SIZE,
+        pool_maxsize=settings.HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(
+        {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"}
+    )
+    return session
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread making requests to DOL, which adapts its
+    rate to throttling: it backs off multiplicatively on 429/503 responses, pausing
+    for as long as any Retry-After asks, and speeds up additively as requests
+    succeed.
+    """
+
+    def __init__(self, rate, min_rate, max_rate):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request is allowed.
+        """
+        while True:
+            with self.lock:
+                current = time.monotonic()
+                if current >= self.updated:
+                    # Allow short bursts of up to a second's worth of requests.
+                    self.tokens = min(
+                        max(self.rate, 1.0),
+                        self.tokens + (current - self.updated) * self.rate,
+                    )
+                    self.updated = current
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+                else:
+                    delay = self.updated - current
+            time.sleep(delay)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def throttle(self, retry_after=None):
+        with self.lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            self.tokens = 0.0
+            if retry_after:
+                self.updated = max(self.updated, time.monotonic() + retry_after)
+
+    def summary(self, throttled_before=0):
+        """
+        Describe the current rate and how often requests have been throttled since
+        the throttle count was throttled_before.
+        """
+        with self.lock:
+            return f"Request rate {self.rate:.1f}/s, throttled {self.throttled - throttled_before} times"
+
+
+def retry_after(response):
+    """
+    Seconds to wait according to a response's Retry-After header, if any.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(
+            (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(),
+            0,
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _session_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(
+                settings.HTTP_RATE_LIMIT,
+                settings.HTTP_MIN_RATE_LIMIT,
+                settings.HTTP_MAX_RATE_LIMIT,
+            )
+    return _rate_limiter
+
+
+def get_cache():
+    """
+    Return the process-wide response cache, or None if HTTP_CACHE_ENABLED is off.
+    """
+    global _cache
+    if not settings.HTTP_CACHE_ENABLED:
+        return None
+    with _session_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                settings.HTTP_CACHE_DIR,
+                settings.HTTP_CACHE_TTL,
+                settings.HTTP_CACHE_MAX_SIZE,
+            )
+    return _cache
+
+
+def get_session():
+    """
+    Return the process-wide session, shared by all scrapers and worker threads so
+    that connections to DOL are reused instead of re-negotiated for every request.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = build_session()
+    return _session
+
+
+def request(method, url, cache=False, **kwargs):
+    """
+    Make a request through the shared session and rate limiter, retrying throttled
+    responses. Returns the last response if it is still throttled after
+    HTTP_MAX_RETRIES retries.
+
+    If cache is set and the response cache is enabled, successful responses are
+    cached by method, URL and JSON payload. Fresh cached responses are returned
+    without a request, and stale ones are revalidated with a conditional request.
+    cache can also be a number of seconds, to use a shorter TTL than the default.
+    """
+    kwargs.setdefault("timeout", settings.HTTP_TIMEOUT)
+    response_cache = get_cache() if cache else None
+    if response_cache is None:
+        return send(method, url, **kwargs)
+
+    key = request_key(method, url, kwargs.get("json"))
+    entry = response_cache.get(key)
+    ttl = response_cache.ttl if cache is True else min(cache, response_cache.ttl)
+    if entry and response_cache.is_fresh(entry, ttl):
+        return response_cache.response(entry)
+    if entry:
+        kwargs["headers"] = {
+            **(kwargs.get("headers") or {}),
+            **response_cache.conditional_headers(entry),
+        }
+
+    try:
+        response = send(method, url, **kwargs)
+    except BaseException:
+        if entry:
+            entry.body.close()
+        raise
+    if response.status_code == 304 and entry:
+        response.close()
+        response_cache.revalidated(entry)
+        return response_cache.response(entry)
+    if entry:
+        entry.body.close()
+    if response.status_code == 200 and "no-store" not in response.headers.get(
+        "Cache-Control", ""
+    ):
+        return response_cache.store(key, response)
+    return response
+
+
+def send(method, url, **kwargs):
+    limiter = get_rate_limiter()
+    for attempt in range(settings.HTTP_MAX_RETRIES + 1):
+        limiter.acquire()
+        response = get_session().request(method, url, **kwargs)
+        if response.status_code not in settings.HTTP_THROTTLE_STATUSES:
+            # Only speed up while DOL is healthy, not while it returns server errors.
+            if response.status_code < 500:
+                limiter.succeeded()
+            return response
+
+        limiter.throttle(retry_after(response))
+        if attempt < settings.HTTP_MAX_RETRIES:
+            response.close()
+    return response
+
+
+def get(url, cache=False, **kwargs):
+    return request("GET", url, cache=cache, **kwargs)
+
+
+def post(url, cache=False, **kwargs):
+    return request("POST", url, cache=cache, **kwargs)
+
+
+def throttle_count():
+    return get_rate_limiter().throttled
+
+
+def rate_limit_summary(throttled_before=0):
+    # The rate limiter lives as long as the process, which on Lambda can outlive
+    # many commands, so commands pass the throttle count they started with.
+    return get_rate_limiter().summary(throttled_before)
@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+from datetime import date
+import gzip
+import os
+import resource
+import sys
+import time
+from tempfile import SpooledTemporaryFile
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from listings.models import Listing
+from listings.rss import SPOOL_MAX_SIZE
+
+BENCHMARK_DIR = "rss/benchmarks"
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def write_synthetic_feed(f, count):
+    """
+    Write an RSS document with count H- entries to a binary file object, without
+    building the whole document in memory.
+    """
+    pub_date = date.today().strftime("%a, %d %b %Y 00:00:00 GMT")
+    f.write(
+        b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<rss version="2.0"><channel><title>Seasonal Jobs</title>\n'
+    )
+    buffer = []
+    for n in range(count):
+        dol_id = f"H-300-{20000 + n // 100000:05d}-{n % 100000:06d}"
+        buffer.append(
+            f"<item><title>Synthetic job #{n}</title>"
+            f"<link>https://seasonaljobs.dol.gov/jobs/{dol_id}</link>"
+            f"<description>Synthetic description for job {n}, "
+            f"generated for benchmarking.</description>"
+            f"<pubDate>{pub_date}</pubDate></item>\n"
+        )
+        if len(buffer) >= 1000:
+            f.write("".join(buffer).encode())
+            buffer = []
+    f.write("".join(buffer).encode())
+    f.write(b"</channel></rss>\n")
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else.
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    return peak / 1024
+
+
+@contextmanager
+def count_queries(counter):
+    def wrapper(execute, sql, params, many, context):
+        counter[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        yield
+
+
+class Command(BaseCommand):
+    help = "Benchmark scrape_rss ingestion against synthetic feeds of increasing size"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            help=f"Number of feed entries to benchmark with, defaults to {' '.join(str(s) for s in DEFAULT_SIZES)}",
+            default=DEFAULT_SIZES,
+        )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            help="Batch size passed on to scrape_rss, defaults to scrape_rss's own default",
+        )
+
+    def handle(self, *args, **options):
+        # Always benchmark against a throwaway copy of the configured database (an
+        # in-memory database for SQLite), never against real data.
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        self.stdout.write(
+            f"Benchmarking scrape_rss on {connection.vendor} ({connection.settings_dict['NAME']})"
+        )
+        try:
+            for size in options["sizes"]:
+                self.benchmark(size, options.get("batch_size"))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def benchmark(self, size, batch_size=None):
+        name = f"{BENCHMARK_DIR}/synthetic-{size}.xml.gz"
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as f:
+            with gzip.GzipFile(fileobj=f, mode="wb") as body:
+                write_synthetic_feed(body, size)
+            f.seek(0)
+            name = default_storage.save(name, File(f))
+
+        scrape_options = {"replay": name}
+        if batch_size:
+            scrape_options["batch_size"] = batch_size
+
+        try:
+            Listing.objects.all().delete()
+            # The first pass inserts every entry, the second finds them all unchanged.
+            for label in ("insert", "unchanged"):
+                queries = [0]
+                with open(os.devnull, "w") as devnull, count_queries(queries):
+                    start = time.perf_counter()
+                    call_command("scrape_rss", stdout=devnull, **scrape_options)
+                    elapsed = time.perf_counter() - start
+
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"{size} entries ({label}): {elapsed:.2f}s, "
+                        f"{size / elapsed:.0f} entries/sec, {queries[0]} queries, "
+                        f"peak RSS {peak_rss_mb():.1f} MB"
+                    )
+                )
+        finally:
+            default_storage.delete(name)
@@ -25,7 +25,7 @@ def listing_to_row(listing, fieldnames):
         "last_seen": listing.last_seen,
         "first_seen": listing.first_seen,
         "pub_date": listing.pub_date,
-        "is_active": (listing.last_seen >= date.today() - timedelta(days=1)),
+        "is_active": listing.delisted_at is None,
         "job_order_pdf": listing.pdf.url if listing.pdf else "",
     }
 
@@ -70,7 +70,7 @@ class Command(BaseCommand):
 
         if options["drupal"]:
             listings_query = listings_query.filter(
-                last_seen__gte=today - timedelta(days=1), scraped=True
+                delisted_at__isnull=True, scraped=True
             )
 
         if options["json"]:
@@ -0,0 +1,147 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from listings import http_client
+from listings.deadline import Deadline, add_deadline_argument
+from listings.models import Listing
+from listings.pdfs import (
+    download_pdf,
+    is_job_order_pdf,
+    pdf_url,
+    store_pdf,
+)
+
+import requests
+import rollbar
+
+
+class Command(BaseCommand):
+    help = "Download job order PDFs for scraped listings that don't have one yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max",
+            type=int,
+            help="Max number of PDFs to download, defaults to 10",
+            default=10,
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            help="Number of PDFs to download at once, defaults to 1",
+            default=1,
+        )
+        add_deadline_argument(parser)
+
+    def handle(self, *args, **options):
+        if not settings.JOB_ORDER_BASE_URL:
+            raise CommandError("JOB_ORDER_BASE_URL must be set")
+
+        max_records = options.get("max", None)
+        concurrency = max(options.get("concurrency") or 1, 1)
+        deadline = Deadline(options.get("deadline"))
+        throttled_before = http_client.throttle_count()
+
+        # Listings whose PDF failed back off, so they don't crowd out the rest.
+        missing_pdfs = Listing.objects.due_for_pdf()
+        listings = list(missing_pdfs.order_by("-created")[:max_records])
+
+        if len(listings) == 0:
+            self.stdout.write(self.style.SUCCESS("No job order PDFs left to fetch!"))
+            return
+
+        self.saved_count = 0
+        self.failed_count = 0
+        queue = list(reversed(listings))
+
+        # Downloads run in the pool, while saving stays on this thread so that Django
+        # connections are never shared between threads.
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {}
+            while queue or pending:
+                while (
+                    queue
+                    and len(pending) < concurrency
+                    and deadline.allows(len(pending) + 1)
+                ):
+                    listing = queue.pop()
+                    pending[executor.submit(download_pdf, listing.dol_id)] = listing
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    listing = pending.pop(future)
+                    deadline.done()
+                    try:
+                        response = future.result()
+                    except requests.RequestException as e:
+                        response = None
+                        error = str(e)
+                    else:
+                        error = f"status code {response.status_code}"
+
+                    # Server errors were already retried by the session, so any
+                    # failure here waits for a later run with record_pdf_failure.
+                    if response is not None and is_job_order_pdf(response):
+                        self.save_pdf(listing, response)
+                    else:
+                        self.report_failure(listing, response, error)
+
+        if deadline.reached:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"Ran out of time with {missing_pdfs.count()} job order PDFs left to fetch"
+                )
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Saved {self.saved_count} and failed to fetch {self.failed_count} job order PDFs"
+            )
+        )
+        self.stdout.write(http_client.rate_limit_summary(throttled_before))
+
+    def save_pdf(self, listing, job_order_pdf):
+        if not store_pdf(listing, job_order_pdf):
+            self.stdout.write(
+                f"Job order PDF unchanged for listing ID {listing.dol_id}"
+            )
+            return
+        listing.save()
+        self.saved_count += 1
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{self.saved_count} - Saved job order PDF for listing ID {listing.dol_id}"
+            )
+        )
+
+    def report_failure(self, listing, job_order_pdf, error):
+        self.failed_count += 1
+        listing.record_pdf_failure()
+        listing.save()
+        # Throttled as in scrape_listings, since only a spike in failures is of interest.
+        if random.randint(0, 10) == 0:
+            rollbar.report_message(
+                "Failed job order PDF request for listing ID",
+                "warning",
+                extra_data={
+                    "dol_id": listing.dol_id,
+                    "pdf_request": job_order_pdf,
+                    "pdf_url": pdf_url(listing.dol_id),
+                },
+            )
+        self.stdout.write(
+            self.style.WARNING(
+                f"Failed job order PDF request for listing ID {listing.dol_id}, {error}, url {pdf_url(listing.dol_id)}"
+            )
+        )
+        if listing.pdf_abandoned:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"Giving up on the job order PDF for listing ID {listing.dol_id} after {listing.pdf_attempts} attempts"
+                )
+            )
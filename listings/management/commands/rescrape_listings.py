@@ -0,0 +1,169 @@
+from datetime import date, timedelta
+import heapq
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.utils import timezone
+
+from listings import datahub, http_client
+from listings.deadline import Deadline, add_deadline_argument
+from listings.models import Listing
+
+import rollbar
+
+# Listings scraped more recently than this aren't worth refreshing yet.
+MIN_AGE = timedelta(days=1)
+LOOKUP_BATCH = 20
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def priority(scraped_at, last_seen, begin_date, now):
+    """
+    How much a listing's scraped data needs refreshing: the older the data, the
+    higher the priority, scaled up for listings seen in the feed recently and for
+    jobs close to their begin date.
+    """
+    age = (now - scraped_at).total_seconds() / 86400
+    activity = 1 / (1 + (now.date() - last_seen).days)
+    begin = parse_date(begin_date) if begin_date else None
+    urgency = 1 / (1 + abs((begin - now.date()).days)) if begin else 0
+    return age * (activity + urgency)
+
+
+class Command(BaseCommand):
+    help = "Re-scrape the active listings whose scraped data most needs refreshing"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max",
+            type=int,
+            help="Max number of listings to re-scrape, defaults to 100",
+            default=100,
+        )
+        parser.add_argument(
+            "--lookup_batch",
+            type=int,
+            help=f"Number of listings to look up per API request, defaults to {LOOKUP_BATCH}",
+            default=LOOKUP_BATCH,
+        )
+        add_deadline_argument(parser)
+
+    def handle(self, *args, **options):
+        if not settings.JOBS_API_URL:
+            raise CommandError("JOBS_API_URL must be set")
+        if not settings.JOBS_API_KEY:
+            raise CommandError("Jobs API Key must be set")
+
+        max_records = max(options.get("max") or 0, 0)
+        lookup_batch = min(
+            max(options.get("lookup_batch") or LOOKUP_BATCH, 1), datahub.MAX_TOP
+        )
+        deadline = Deadline(options.get("deadline"))
+        throttled_before = http_client.throttle_count()
+
+        listings = self.prioritize(max_records)
+        if not listings:
+            self.stdout.write(self.style.SUCCESS("No listings need re-scraping!"))
+            return
+
+        self.updated_count = 0
+        self.unchanged_count = 0
+        api_calls = 0
+        for i in range(0, len(listings), lookup_batch):
+            if not deadline.allows():
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"Ran out of time with {len(listings) - i} prioritized listings left to re-scrape"
+                    )
+                )
+                break
+
+            batch = listings[i : i + lookup_batch]
+            result = datahub.lookup([listing.dol_id for listing in batch])
+            api_calls += 1
+            if result.error:
+                msg = (
+                    f"API call failed for listing, status code {result.response.status_code}"
+                    if result.error == "status"
+                    else "Invalid JSON"
+                )
+                rollbar.report_message(
+                    msg,
+                    "error",
+                    extra_data={
+                        "dol_id": ", ".join(listing.dol_id for listing in batch)
+                    },
+                )
+                self.stdout.write(self.style.ERROR(msg))
+            else:
+                self.save_batch(batch, result.records)
+            deadline.done()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Refreshed {self.updated_count} and found {self.unchanged_count} unchanged listings with {api_calls} API calls"
+            )
+        )
+        self.stdout.write(http_client.rate_limit_summary(throttled_before))
+
+    def prioritize(self, count):
+        """
+        Return the count active, scraped listings that most need refreshing, highest
+        priority first. Only the top count are held in memory at once.
+        """
+        now = timezone.now()
+        candidates = (
+            Listing.objects.filter(
+                scraped=True,
+                delisted_at__isnull=True,
+                scraped_at__lt=now - MIN_AGE,
+            )
+            .values_list("pk", "scraped_at", "last_seen", "scraped_data__begin_date")
+            .iterator()
+        )
+
+        heap = []
+        for pk, scraped_at, last_seen, begin_date in candidates:
+            item = (priority(scraped_at, last_seen, begin_date, now), pk)
+            if len(heap) < count:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+        ranked = [pk for _, pk in sorted(heap, reverse=True)]
+        listings = Listing.objects.in_bulk(ranked)
+        return [listings[pk] for pk in ranked]
+
+    def save_batch(self, batch, records):
+        by_case_number = datahub.records_by_case_number(records)
+        timestamp = timezone.now()
+        for listing in batch:
+            # Listings the API no longer returns still count as checked, so that they
+            # don't stay at the front of the queue.
+            listing.scraped_at = timestamp
+            scraped_data = by_case_number.get(listing.dol_id)
+            if scraped_data is None:
+                continue
+
+            previous_data = listing.scraped_data
+            listing.scraped_data = scraped_data
+            listing.clean()
+            if listing.scraped_data == previous_data:
+                self.unchanged_count += 1
+                continue
+
+            listing.modified = timestamp
+            self.updated_count += 1
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{self.updated_count} - Refreshed data for listing ID {listing.dol_id}"
+                )
+            )
+
+        Listing.objects.bulk_update(batch, ["scraped_data", "scraped_at", "modified"])
@@ -1,14 +1,36 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import random
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.utils import timezone
 
+from listings import datahub, http_client
+from listings.deadline import Deadline, add_deadline_argument
 from listings.models import Listing
+from listings.pdfs import download_pdf, is_job_order_pdf, pdf_url, store_pdf
 
 import requests
 import rollbar
 
+BATCH_SIZE = 50
+UPDATE_FIELDS = [
+    "scraped",
+    "scraped_data",
+    "scraped_at",
+    "pdf",
+    "pdf_sha256",
+    "pdf_attempts",
+    "pdf_next_attempt_at",
+    "pdf_abandoned",
+    "modified",
+    "scrape_attempts",
+    "last_attempt_at",
+    "next_attempt_at",
+    "scrape_abandoned",
+]
+
 
 class Command(BaseCommand):
     help = "Scrape data from SeasonalJobs RSS feed in to the database"
@@ -20,6 +42,30 @@ class Command(BaseCommand):
             help="Max number of entries to process, defaults to 1",
             default=10,
         )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            help="Number of API lookups and PDF downloads to run at once, defaults to 1",
+            default=1,
+        )
+        parser.add_argument(
+            "--lookup_batch",
+            type=int,
+            help="Number of listings to look up per API request, defaults to 1",
+            default=1,
+        )
+        parser.add_argument(
+            "--skip_pdfs",
+            action="store_true",
+            help="Don't download job order PDFs, leaving them to the fetch_pdfs command",
+        )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            help=f"Number of finished listings to write to the database at once, defaults to {BATCH_SIZE}",
+            default=BATCH_SIZE,
+        )
+        add_deadline_argument(parser)
 
     def handle(self, *args, **options):
         if not (settings.JOBS_API_URL and settings.JOB_ORDER_BASE_URL):
@@ -28,134 +74,331 @@ class Command(BaseCommand):
             raise CommandError("Jobs API Key must be set")
 
         max_records = options.get("max", None)
+        concurrency = max(options.get("concurrency") or 1, 1)
+        lookup_batch = min(max(options.get("lookup_batch") or 1, 1), datahub.MAX_TOP)
+        skip_pdfs = options.get("skip_pdfs", False)
+        self.batch_size = max(options.get("batch_size") or BATCH_SIZE, 1)
+        deadline = Deadline(options.get("deadline"))
+        throttled_before = http_client.throttle_count()
 
-        unscraped_listings = Listing.objects.filter(scraped=False).order_by("-created")[
-            :max_records
-        ]
+        unscraped_listings = list(
+            Listing.objects.due_for_scraping().order_by("-created")[:max_records]
+        )
 
         if len(unscraped_listings) == 0:
             self.stdout.write(self.style.SUCCESS("No listings left to scrape!"))
             return
 
-        scraped_count = 0
-        for listing in unscraped_listings:
-            if scraped_count >= max_records:
-                break
-
-            payload = {
-                "searchFields": "case_number",
-                "orderby": "search.score() desc",
-                "search": f'"{listing.dol_id}"',
-                "top": 1,
-            }
-            api_response = requests.post(
-                settings.JOBS_API_URL,
-                json=payload,
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.149 Safari/537.36",
-                    "Content-Type": "application/json",
-                },
-                timeout=30,
+        self.scraped_count = 0
+        self.reused_count = 0
+        self.abandoned_ids = set()
+        self.api_calls = 0
+        # Every record the API returns during this run, by case number, so that
+        # records returned for a different listing than the one asked for are used
+        # instead of being looked up again.
+        self.records = {}
+        self.scraped_ids = set()
+        self.queued_ids = {listing.dol_id for listing in unscraped_listings}
+        self.listings = {listing.dol_id: listing for listing in unscraped_listings}
+        self.waiting_ids = set(self.queued_ids)
+        self.in_flight_ids = set()
+        # Changed listings are written in bulk, once any PDF has been uploaded, so
+        # that each listing is only written once.
+        self.unsaved = {}
+        self.awaiting_pdf = set()
+        queue = deque(unscraped_listings)
+
+        try:
+            # Network requests run in the pool, while all database reads and writes
+            # stay on this thread so that Django connections are never shared between
+            # threads.
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                pending = {}
+
+                def fetch_pdfs(listings):
+                    if skip_pdfs:
+                        return
+                    for listing in listings:
+                        self.awaiting_pdf.add(listing.pk)
+                        pending[executor.submit(download_pdf, listing.dol_id)] = (
+                            "pdf",
+                            listing,
+                        )
+
+                while True:
+                    # Lookups are submitted as others finish, so that each batch can
+                    # be checked against the records returned so far.
+                    lookups = sum(1 for job, _ in pending.values() if job == "lookup")
+                    while (
+                        queue
+                        and lookups < concurrency
+                        and self.scraped_count < max_records
+                        and deadline.allows(lookups + 1)
+                    ):
+                        batch, reused = self.next_batch(queue, lookup_batch)
+                        fetch_pdfs(reused)
+                        if batch:
+                            future = executor.submit(
+                                datahub.lookup, [listing.dol_id for listing in batch]
+                            )
+                            pending[future] = ("lookup", batch)
+                            self.in_flight_ids.update(l.dol_id for l in batch)
+                            lookups += 1
+                            self.api_calls += 1
+
+                    if not pending:
+                        break
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job, target = pending.pop(future)
+                        if job == "lookup":
+                            self.in_flight_ids.difference_update(
+                                l.dol_id for l in target
+                            )
+                        try:
+                            result = future.result()
+                        except requests.RequestException as e:
+                            result = None
+                            error = e
+
+                        if job == "pdf":
+                            self.save_pdf(target, result)
+                        elif result is None:
+                            self.save_failed_lookup(target, error)
+                            deadline.done()
+                        else:
+                            fetch_pdfs(self.save_lookup(target, result))
+                            deadline.done()
+
+                    self.flush()
+        finally:
+            # Keep whatever was scraped, even if the run fails part way through, in
+            # which case PDFs still being downloaded are left for fetch_pdfs.
+            self.awaiting_pdf.clear()
+            self.flush(force=True)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Scraped {self.scraped_count} listings with {self.api_calls} API calls"
+                + (
+                    f", reusing {self.reused_count} records returned for other listings"
+                    if self.reused_count
+                    else ""
+                )
             )
-            if api_response.status_code != 200:
-                msg = f"API call failed for listing, status code {api_response.status_code}"
-                rollbar.report_message(
-                    msg,
-                    "error",
-                    extra_data={
-                        "dol_id": listing.dol_id,
-                    },
+        )
+        if self.abandoned_ids:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"Gave up on {len(self.abandoned_ids)} listings after {settings.SCRAPE_MAX_ATTEMPTS} failed attempts"
                 )
-                self.stdout.write(self.style.ERROR(msg))
-                continue
-
-            try:
-                scraped_data_package = api_response.json()["value"]
-                if len(scraped_data_package) == 1:
-                    scraped_data = scraped_data_package[0]
-                else:
-                    continue
-            except ValueError or IndexError:
-                msg = f"Invalid JSON"
-                self.stdout.write(self.style.ERROR(msg))
-                rollbar.report_message(
-                    msg,
-                    "error",
-                    extra_data={"dol_id": listing.dol_id, "response": api_response},
+            )
+        if deadline.reached:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"Ran out of time with {Listing.objects.due_for_scraping().count()} listings still due for scraping"
                 )
+            )
+        self.stdout.write(http_client.rate_limit_summary(throttled_before))
+
+    def next_batch(self, queue, size):
+        """
+        Take the next batch of listings to look up from the queue. Listings already
+        scraped during this run are dropped, and those with a record returned by an
+        earlier lookup are saved straight away and returned separately.
+        """
+        batch = []
+        reused = []
+        while queue and len(batch) < size:
+            listing = queue.popleft()
+            self.waiting_ids.discard(listing.dol_id)
+            if listing.dol_id in self.scraped_ids:
+                continue
+            if listing.dol_id in self.records:
+                self.save_scraped_data(listing, self.records[listing.dol_id])
+                self.reused_count += 1
+                if not listing.pdf:
+                    reused.append(listing)
                 continue
+            batch.append(listing)
+        return batch, reused
 
-            scrape_successful = True
-            if scraped_data["case_number"] != listing.dol_id:
-                msg = f"Case number mismatch between scraped data for DOL ID {listing.dol_id}. Scraped URL {settings.JOBS_API_URL}"
-                self.stdout.write(self.style.ERROR(msg))
+    def save_lookup(self, batch, result):
+        """
+        Save the result of looking up a batch of listings, matching records back to
+        listings by case number. Returns the listings whose PDFs still need to be
+        downloaded.
+        """
+        dol_ids = ", ".join(listing.dol_id for listing in batch)
+        if result.error == "status":
+            msg = f"API call failed for listing, status code {result.response.status_code}"
+            rollbar.report_message(
+                msg,
+                "error",
+                extra_data={
+                    "dol_id": dol_ids,
+                },
+            )
+            self.stdout.write(self.style.ERROR(msg))
+            self.save_failed_attempts(batch)
+            return []
 
-                # Try to parse the data anyway.
-                original_listing = listing
-                try:
-                    listing = Listing.objects.get(
-                        dol_id=scraped_data["case_number"], scraped=False
-                    )
-                except Listing.DoesNotExist:
-                    listing = (
-                        original_listing  # Save this value so we can check for a PDF
-                    )
-                    scrape_successful = False
-
-            if scrape_successful:
-                listing.scraped = True
-                listing.scraped_data = scraped_data
-                listing.clean()
-                listing.save()
-                scraped_count += 1
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f"{scraped_count} - Saved data for listing ID {listing.dol_id}"
-                    )
-                )
+        if result.error == "json":
+            msg = f"Invalid JSON"
+            self.stdout.write(self.style.ERROR(msg))
+            rollbar.report_message(
+                msg,
+                "error",
+                extra_data={"dol_id": dol_ids, "response": result.response},
+            )
+            self.save_failed_attempts(batch)
+            return []
+
+        by_case_number = datahub.records_by_case_number(result.records)
+        for case_number, record in by_case_number.items():
+            self.records.setdefault(case_number, record)
 
-            if listing.pdf:
+        needs_pdf = []
+        for listing in batch:
+            if listing.dol_id in self.scraped_ids:
+                by_case_number.pop(listing.dol_id, None)
                 continue
+            scraped_data = by_case_number.pop(listing.dol_id, None)
+            if scraped_data is None and listing.dol_id in self.records:
+                # Returned by another batch's lookup while this one was in flight.
+                scraped_data = self.records[listing.dol_id]
+                self.reused_count += 1
+            if scraped_data is not None:
+                self.save_scraped_data(listing, scraped_data)
+                if not listing.pdf:
+                    needs_pdf.append(listing)
 
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/42.0.2311.135 Safari/537.36 Edge/12.246"
-            }
-            pdf_url = f"{settings.JOB_ORDER_BASE_URL}{listing.dol_id}"
-            job_order_pdf = requests.get(
-                pdf_url,
-                headers=headers,
-                timeout=30,
+        # Anything left over is a case that wasn't asked for.
+        if by_case_number:
+            msg = f"Case number mismatch between scraped data for DOL ID {dol_ids}. Scraped URL {settings.JOBS_API_URL}"
+            self.stdout.write(self.style.ERROR(msg))
+
+            # Listings in this run that are still queued or being looked up will pick
+            # their record up from self.records. Those whose own lookup has already
+            # missed are saved now, and any others are parsed anyway.
+            queued = self.queued_ids.intersection(by_case_number) - self.scraped_ids
+            for dol_id in queued - self.waiting_ids - self.in_flight_ids:
+                listing = self.listings[dol_id]
+                self.save_scraped_data(listing, by_case_number[dol_id])
+                self.reused_count += 1
+                if not listing.pdf:
+                    needs_pdf.append(listing)
+            other_listings = Listing.objects.filter(
+                dol_id__in=list(set(by_case_number) - self.queued_ids), scraped=False
             )
+            for listing in other_listings:
+                self.save_scraped_data(listing, by_case_number[listing.dol_id])
+                if not listing.pdf:
+                    needs_pdf.append(listing)
 
-            if (
-                job_order_pdf.status_code in (200, 301)
-                and job_order_pdf.url != "https://seasonaljobs.dol.gov/system/404"
-            ):
-                listing.pdf = ContentFile(
-                    job_order_pdf.content, name=f"{listing.dol_id}.pdf"
-                )
-                listing.save()
+            # If none of them were ours, still check for PDFs for the listings the
+            # API didn't return.
+            if not other_listings and not queued:
+                needs_pdf += [
+                    listing
+                    for listing in batch
+                    if not listing.scraped and not listing.pdf
+                ]
+
+        self.save_failed_attempts([listing for listing in batch if not listing.scraped])
+        return needs_pdf
+
+    def save_failed_lookup(self, batch, error):
+        dol_ids = ", ".join(listing.dol_id for listing in batch)
+        msg = f"API call failed for listing, {error}"
+        rollbar.report_message(msg, "error", extra_data={"dol_id": dol_ids})
+        self.stdout.write(self.style.ERROR(msg))
+        self.save_failed_attempts(batch)
+
+    def save_failed_attempts(self, listings):
+        """
+        Schedule listings that couldn't be scraped to be retried later, or give up on
+        them if they have failed too many times.
+        """
+        for listing in listings:
+            listing.record_scrape_attempt(succeeded=False)
+            self.unsaved[listing.pk] = listing
+            if listing.scrape_abandoned:
+                self.abandoned_ids.add(listing.dol_id)
                 self.stdout.write(
-                    self.style.SUCCESS(
-                        f"{scraped_count} - Saved job order PDF for listing ID {listing.dol_id}"
+                    self.style.WARNING(
+                        f"Giving up on scraping listing ID {listing.dol_id} after {listing.scrape_attempts} attempts"
                     )
                 )
-            else:
-                # We want to track in rollbar if there's a spike in this error because maybe then
-                # PDF scraping is broken entirely, but don't need to track every single occurance,
-                # so throttling to only log 1/10 of the occurences.
-                if random.randint(0, 10) == 0:
-                    rollbar.report_message(
-                        "Failed job order PDF request for listing ID",
-                        "warning",
-                        extra_data={
-                            "dol_id": listing.dol_id,
-                            "pdf_request": job_order_pdf,
-                            "pdf_url": pdf_url,
-                        },
-                    )
+
+    def save_scraped_data(self, listing, scraped_data):
+        listing.scraped = True
+        listing.scraped_data = scraped_data
+        listing.record_scrape_attempt(succeeded=True)
+        self.abandoned_ids.discard(listing.dol_id)
+        listing.clean()
+        listing.modified = listing.scraped_at = timezone.now()
+        self.unsaved[listing.pk] = listing
+        self.scraped_ids.add(listing.dol_id)
+        self.scraped_count += 1
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{self.scraped_count} - Saved data for listing ID {listing.dol_id}"
+            )
+        )
+
+    def flush(self, force=False):
+        """
+        Write changed listings that aren't waiting on a PDF to the database, once
+        there are at least batch_size of them or if forced.
+        """
+        ready = [
+            listing
+            for pk, listing in self.unsaved.items()
+            if pk not in self.awaiting_pdf
+        ]
+        if not ready or (len(ready) < self.batch_size and not force):
+            return
+
+        Listing.objects.bulk_update(ready, UPDATE_FIELDS)
+        for listing in ready:
+            del self.unsaved[listing.pk]
+
+    def save_pdf(self, listing, job_order_pdf):
+        self.awaiting_pdf.discard(listing.pk)
+        # job_order_pdf is None if the request itself failed.
+        if job_order_pdf is not None and is_job_order_pdf(job_order_pdf):
+            # Upload to storage now, leaving the database write to the next flush.
+            if not store_pdf(listing, job_order_pdf):
                 self.stdout.write(
-                    self.style.WARNING(
-                        f"{scraped_count} - Failed job order PDF request for listing ID {listing.dol_id}, url {pdf_url}"
-                    )
+                    f"{self.scraped_count} - Job order PDF unchanged for listing ID {listing.dol_id}"
+                )
+                return
+            self.unsaved[listing.pk] = listing
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{self.scraped_count} - Saved job order PDF for listing ID {listing.dol_id}"
                 )
+            )
+        else:
+            listing.record_pdf_failure()
+            self.unsaved[listing.pk] = listing
+            # We want to track in rollbar if there's a spike in this error because maybe then
+            # PDF scraping is broken entirely, but don't need to track every single occurance,
+            # so throttling to only log 1/10 of the occurences.
+            if random.randint(0, 10) == 0:
+                rollbar.report_message(
+                    "Failed job order PDF request for listing ID",
+                    "warning",
+                    extra_data={
+                        "dol_id": listing.dol_id,
+                        "pdf_request": job_order_pdf,
+                        "pdf_url": pdf_url(listing.dol_id),
+                    },
+                )
+            self.stdout.write(
+                self.style.WARNING(
+                    f"{self.scraped_count} - Failed job order PDF request for listing ID {listing.dol_id}, url {pdf_url(listing.dol_id)}"
+                )
+            )
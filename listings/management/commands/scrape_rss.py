@@ -1,19 +1,109 @@
-from time import strftime
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+import json
 
+from django.core.files import File
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
 from django.utils.timezone import now
-from django.db import IntegrityError
 
+from listings.deadline import Deadline, add_deadline_argument
 from listings.models import Listing, StaticValue
+from listings.rss import (
+    DOL_ID_REGEX,
+    archive_feed,
+    feedparser_entries,
+    fetch_feed,
+    fingerprint,
+    iter_feed_entries,
+    open_snapshot,
+)
 
 import feedparser
 import rollbar
-import re
 
 ETAG_KEY = "jobs_rss__etag"
 MODIFIED_KEY = "jobs_rss__modified"
-DOL_ID_REGEX = re.compile(r"(H-[0-9\-]+)")
+CHECKPOINT_KEY = "jobs_rss__checkpoint"
+BATCH_SIZE = 500
+# Max number of IDs per dol_id__in lookup, to stay under database parameter limits.
+LOOKUP_CHUNK_SIZE = 1000
+UPDATE_FIELDS = [
+    "link",
+    "title",
+    "description",
+    "pub_date",
+    "rss_hash",
+    "last_seen",
+    "delisted_at",
+    "modified",
+]
+
+
+def feed_suffix(url):
+    """
+    Suffix for a feed's StaticValue keys and storage names. The main feed keeps the
+    unsuffixed names it has always used.
+    """
+    if url == settings.JOBS_RSS_FEED_URL:
+        return ""
+    return "__" + sha1(url.encode("utf-8")).hexdigest()[:12]
+
+
+def feed_cache_name(url):
+    """
+    Storage path of a feed being ingested, kept until ingestion completes.
+    """
+    return f"rss/job_rss{feed_suffix(url)}.xml"
+
+
+def load_feed_state(url):
+    """
+    Return the saved (etag, modified) values for a feed, or None for either.
+    """
+    values = dict(
+        StaticValue.objects.filter(
+            key__in=[ETAG_KEY + feed_suffix(url), MODIFIED_KEY + feed_suffix(url)]
+        ).values_list("key", "value")
+    )
+    return (
+        values.get(ETAG_KEY + feed_suffix(url)),
+        values.get(MODIFIED_KEY + feed_suffix(url)),
+    )
+
+
+def merge_entries(feed_entries):
+    """
+    Merge entries from several feeds by DOL ID, in order of first appearance with
+    later feeds' fields winning. Entries without a DOL ID are passed through.
+    """
+    merged = {}
+    invalid = []
+    for entries in feed_entries:
+        for entry in entries:
+            if entry.dol_id:
+                merged[entry.dol_id] = entry
+            else:
+                invalid.append(entry)
+    yield from merged.values()
+    yield from invalid
+
+
+def existing_listings(dol_ids):
+    """
+    Return a {dol_id: (pk, rss_hash)} map of the listings that already exist among
+    the given IDs, without loading any other columns.
+    """
+    dol_ids = list(dol_ids)
+    existing = {}
+    for i in range(0, len(dol_ids), LOOKUP_CHUNK_SIZE):
+        rows = Listing.objects.filter(
+            dol_id__in=dol_ids[i : i + LOOKUP_CHUNK_SIZE]
+        ).values_list("dol_id", "pk", "rss_hash")
+        existing.update({dol_id: (pk, rss_hash) for dol_id, pk, rss_hash in rows})
+    return existing
 
 
 class Command(BaseCommand):
@@ -33,8 +123,40 @@ class Command(BaseCommand):
             help="Skip updating existing records if found?",
         )
 
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            help=f"Number of entries to write to the database per transaction, defaults to {BATCH_SIZE}",
+            default=BATCH_SIZE,
+        )
+
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="Parse the feed incrementally instead of loading it all with feedparser",
+        )
+
+        parser.add_argument(
+            "--feed",
+            action="append",
+            help="RSS feed URL to ingest, can be given more than once. Defaults to the JOBS_RSS_FEED_URLS setting",
+        )
+
+        parser.add_argument(
+            "--archive",
+            action="store_true",
+            help="Save a compressed snapshot of the fetched feed to storage (implies --stream)",
+        )
+
+        parser.add_argument(
+            "--replay",
+            help="Ingest entries from a stored feed snapshot instead of fetching the feed",
+        )
+
+        add_deadline_argument(parser)
+
     def handle(self, *args, **options):
-        if not settings.JOBS_RSS_FEED_URL:
+        if not (settings.JOBS_RSS_FEED_URL and settings.JOBS_RSS_FEED_URLS):
             raise CommandError("RSS feed URL must be set")
 
         max_records = None
@@ -45,108 +167,420 @@ class Command(BaseCommand):
         if options.get("skip_update", False):
             update = False
 
-        # Check for saved etag and modified keys
-        try:
-            etag = StaticValue.objects.get(key=ETAG_KEY).value
-        except StaticValue.DoesNotExist:
-            etag = None
+        batch_size = max(options.get("batch_size") or BATCH_SIZE, 1)
+        self.deadline = Deadline(options.get("deadline"))
+        self.created_count = 0
+        self.updated_count = 0
+        self.unchanged_count = 0
+        self.delisted_count = 0
+
+        if options.get("replay"):
+            # Replayed snapshots are ingested without touching the live feed's etag,
+            # checkpoint or delisting state.
+            self.stdout.write(
+                self.style.SUCCESS(f"Replaying RSS snapshot {options['replay']}")
+            )
+            with open_snapshot(options["replay"]) as body:
+                self.ingest(iter_feed_entries(body), update, batch_size, max_records)
+            self.write_summary()
+            return
 
+        feed_urls = options.get("feed") or settings.JOBS_RSS_FEED_URLS
+
+        # A checkpoint means the last run stopped part way through ingesting a feed.
         try:
-            modified = StaticValue.objects.get(key=MODIFIED_KEY).value
+            checkpoint = json.loads(StaticValue.objects.get(key=CHECKPOINT_KEY).value)
         except StaticValue.DoesNotExist:
-            modified = None
+            checkpoint = None
+        # It only lists the feeds that had new entries, not those that were unchanged.
+        if checkpoint and (
+            not checkpoint.get("feeds")
+            or not set(checkpoint["feeds"]) <= set(feed_urls)
+        ):
+            checkpoint = None
 
-        rss_entries = feedparser.parse(
-            settings.JOBS_RSS_FEED_URL,
-            etag=etag,
-            modified=modified,
-            agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/42.0.2311.135 Safari/537.36 Edge/12.246",
+        # Archiving needs the raw feed body, so it always uses the streaming fetch.
+        archive = options.get("archive", False)
+        stream = options.get("stream", False) or archive
+        cached_bodies = []
+        start_index = 0
+        checkpoint_urls = [
+            url for url in feed_urls if checkpoint and url in checkpoint["feeds"]
+        ]
+        if checkpoint and all(
+            default_storage.exists(feed_cache_name(url)) for url in checkpoint_urls
+        ):
+            for url in checkpoint_urls:
+                cached_bodies.append(default_storage.open(feed_cache_name(url), "rb"))
+            if stream:
+                feed_entries = [iter_feed_entries(body) for body in cached_bodies]
+            else:
+                feed_entries = [
+                    feedparser_entries(feedparser.parse(body.read()))
+                    for body in cached_bodies
+                ]
+            feed_state = checkpoint["feeds"]
+            start_index = checkpoint["index"]
+        else:
+            fetched = self.fetch_feeds(feed_urls, stream, archive)
+            if not fetched:
+                return
+            feed_entries = [entries for entries, _ in fetched.values()]
+            feed_state = {url: state for url, (_, state) in fetched.items()}
+
+            # Without a cached body, only resume if the feeds are the same ones.
+            if (
+                checkpoint
+                and checkpoint["feeds"] == feed_state
+                and any(state["etag"] for state in feed_state.values())
+            ):
+                start_index = checkpoint["index"]
+
+        if start_index:
+            self.stdout.write(
+                self.style.SUCCESS(f"Resuming RSS ingestion after entry {start_index}")
+            )
+
+        if len(feed_entries) == 1:
+            entries = feed_entries[0]
+        else:
+            entries = merge_entries(feed_entries)
+
+        finished = self.ingest(
+            entries,
+            update,
+            batch_size,
+            max_records,
+            feed_state=feed_state,
+            start_index=start_index,
+            # Listings can only be delisted if every feed was pulled in full.
+            delist=len(feed_state) == len(feed_urls),
         )
 
-        if rss_entries.get("bozo", False):
-            # Error code from feed scraper
-            msg = f"Error pulling RSS Feed {rss_entries.get('bozo_exception', '')}"
+        for body in cached_bodies:
+            body.close()
+        # Clean up the cached feeds, unless the run stopped early and the next one will
+        # resume from them.
+        if finished:
+            for url in feed_urls:
+                if default_storage.exists(feed_cache_name(url)):
+                    default_storage.delete(feed_cache_name(url))
 
-            self.stdout.write(self.style.ERROR(msg))
-            rollbar.report_message(msg, "error")
+        self.write_summary()
 
-        if rss_entries.get("status", False) not in [200, 301]:
-            # Error code from feed scraper
-            msg = f"RSS Feed status code: {rss_entries.get('status', False)}, not 200"
-            self.stdout.write(self.style.ERROR(msg))
-            rollbar.report_message(msg, "error")
-            return
+    def fetch_feeds(self, feed_urls, stream=False, archive=False):
+        """
+        Fetch all feeds concurrently, using each feed's saved etag and modified
+        values. Returns a {url: (entries, state)} dict, in feed order, of the feeds
+        that have new entries, where state holds the feed's new etag and modified.
+        """
+        saved_states = {url: load_feed_state(url) for url in feed_urls}
 
-        elif rss_entries.get("version", "") == "":
-            self.stdout.write(self.style.SUCCESS(f"RSS fetched, but no new entries"))
-            return
+        def fetch(url):
+            etag, modified = saved_states[url]
+            if stream:
+                return self.fetch_stream(url, etag, modified, archive)
+            return self.fetch_feedparser(url, etag, modified)
+
+        with ThreadPoolExecutor(max_workers=len(feed_urls)) as executor:
+            results = list(executor.map(fetch, feed_urls))
+
+        return {
+            url: (result[0], {"etag": result[1], "modified": result[2]})
+            for url, result in zip(feed_urls, results)
+            if result is not None
+        }
 
+    def ingest(
+        self,
+        entries,
+        update,
+        batch_size,
+        max_records,
+        feed_state=None,
+        start_index=0,
+        delist=True,
+    ):
+        """
+        Write feed entries to the database in batches, one transaction per batch.
+
+        If feed_state maps each feed URL to its new etag and modified values, a
+        checkpoint is saved with every batch, the etag and modified values are saved
+        with the final batch, and (if delist is set) listings missing from a complete
+        pull are marked as delisted. Entries up to start_index were written by a
+        previous run and are skipped.
+
+        Stops before a batch that isn't projected to be written before the deadline,
+        leaving the checkpoint for the next run to resume from. Returns whether all
+        the entries were ingested.
+        """
+        batch = {}
+        feed_ids = set()
+        complete = True
         processed_count = 0
-        for entry in rss_entries.get("entries", []):
+        written_index = start_index
+        for entry in entries:
             processed_count += 1
+            if processed_count <= start_index:
+                if entry.dol_id:
+                    feed_ids.add(entry.dol_id)
+                continue
             if max_records and processed_count > max_records:
+                complete = False
                 break
 
-            link = entry.get("link", "")
-            dol_ids = DOL_ID_REGEX.findall(link)
-
-            if len(dol_ids) == 0:
-                msg = f'No Dol ID found in RSS listing, with link="{link}"'
-                rollbar.report_message(msg, "error")
-                continue
-            elif len(dol_ids) > 1:
-                msg = f'Multiple Dol IDs found in RSS listing, with link="{link}"'
+            if not entry.dol_id:
+                if DOL_ID_REGEX.findall(entry.link):
+                    msg = f'Multiple Dol IDs found in RSS listing, with link="{entry.link}"'
+                else:
+                    msg = f'No Dol ID found in RSS listing, with link="{entry.link}"'
                 rollbar.report_message(msg, "error")
                 continue
-
-            dol_id = dol_ids[0]
-            pub_date = strftime("%Y-%m-%d", entry.get("published_parsed", ""))
-            if not dol_id:
-                self.stdout.write(
-                    self.style.WARNING(
-                        f"Invalid entry with link {entry.get('link', 'N/A')}"
-                    )
+            if not entry.pub_date:
+                rollbar.report_message(
+                    f'No publication date found in RSS listing, with link="{entry.link}"',
+                    "error",
                 )
                 continue
 
             defaults = {
-                "link": entry.get("link", ""),
-                "title": entry.get("title", ""),
-                "description": entry.get("description", ""),
-                "pub_date": pub_date,
-                "last_seen": now(),
+                "link": entry.link,
+                "title": entry.title,
+                "description": entry.description,
+                "pub_date": entry.pub_date,
+                "rss_hash": fingerprint(
+                    entry.link, entry.title, entry.description, entry.pub_date
+                ),
+                "last_seen": now().date(),
+                "delisted_at": None,
             }
-            if update:
-                l, _ = Listing.objects.update_or_create(
-                    dol_id=dol_id, defaults=defaults
-                )
-
-            else:
-                _ = True
-                try:
-                    Listing.objects.create(dol_id=dol_id, **defaults)
-                except IntegrityError:
+            feed_ids.add(entry.dol_id)
+            # Later entries for the same ID win, as they would with row-by-row writes.
+            batch[entry.dol_id] = (processed_count, defaults)
+            if len(batch) >= batch_size:
+                if not self.deadline.allows():
                     self.stdout.write(
-                        self.style.SUCCESS(
-                            f"{processed_count} skipped updating entry with title {defaults['title']} and id {dol_id}"
+                        self.style.WARNING(
+                            f"Ran out of time with the feed ingested up to entry {written_index}"
+                            + (
+                                ", the next run will resume from there"
+                                if feed_state
+                                else ""
+                            )
+                        )
+                    )
+                    return False
+
+                with transaction.atomic():
+                    self.write_batch(batch, update)
+                    if feed_state is not None:
+                        StaticValue.objects.update_or_create(
+                            key=CHECKPOINT_KEY,
+                            defaults={
+                                "value": json.dumps(
+                                    {"feeds": feed_state, "index": processed_count}
+                                )
+                            },
                         )
+                self.deadline.done()
+                written_index = processed_count
+                batch = {}
+
+        # Commit the feed's etag and last_modified with the final batch, so they are
+        # never saved if any entries were left unwritten.
+        with transaction.atomic():
+            if batch:
+                self.write_batch(batch, update)
+
+            if feed_state is None:
+                return True
+
+            for url, state in feed_state.items():
+                if state["etag"]:
+                    StaticValue.objects.update_or_create(
+                        key=ETAG_KEY + feed_suffix(url),
+                        defaults={"value": state["etag"]},
                     )
-                    continue
 
-            operation = "Created" if _ else "Updated"
+                if state["modified"]:
+                    StaticValue.objects.update_or_create(
+                        key=MODIFIED_KEY + feed_suffix(url),
+                        defaults={"value": state["modified"]},
+                    )
+
+            # Only a complete pull of the feed tells us which listings have left it.
+            if complete and delist:
+                self.mark_delisted(feed_ids)
+
+            StaticValue.objects.filter(key=CHECKPOINT_KEY).delete()
+
+        return True
+
+    def write_summary(self):
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {self.created_count}, updated {self.updated_count} and skipped {self.unchanged_count} unchanged entries"
+            )
+        )
+        if self.delisted_count:
             self.stdout.write(
                 self.style.SUCCESS(
-                    f"{processed_count} - {operation} entry with title {defaults['title']} and id {dol_id}"
+                    f"Marked {self.delisted_count} listings no longer in the feed as delisted"
                 )
             )
 
-        # Assuming scrape was successful, save etag and last_modified.
-        if rss_entries.get("etag", False):
-            StaticValue.objects.update_or_create(
-                key=ETAG_KEY, defaults={"value": rss_entries.get("etag", "")}
+    def fetch_feedparser(self, url, etag, modified):
+        """
+        Download the feed and parse it all at once with feedparser. Returns an
+        (entries, etag, modified) tuple, or None if there is nothing to ingest.
+        """
+        feed = self.fetch_body(url, etag, modified)
+        if feed is None:
+            return None
+
+        rss_entries = self.parse_feed(feed.body)
+        if rss_entries is None:
+            return None
+        return feedparser_entries(rss_entries), feed.etag or "", feed.modified or ""
+
+    def parse_feed(self, body):
+        """
+        Parse a whole feed body with feedparser, or return None if it has no entries.
+        """
+        rss_entries = feedparser.parse(body.read())
+
+        if rss_entries.get("bozo", False):
+            # Error code from feed scraper
+            msg = f"Error pulling RSS Feed {rss_entries.get('bozo_exception', '')}"
+
+            self.stdout.write(self.style.ERROR(msg))
+            rollbar.report_message(msg, "error")
+
+        if rss_entries.get("version", "") == "":
+            self.stdout.write(self.style.SUCCESS(f"RSS fetched, but no new entries"))
+            return None
+
+        return rss_entries
+
+    def fetch_stream(self, url, etag, modified, archive=False):
+        """
+        Download the feed and parse it incrementally. Returns an (entries, etag,
+        modified) tuple, or None if there is nothing to ingest.
+        """
+        feed = self.fetch_body(url, etag, modified, archive)
+        if feed is None:
+            return None
+        return iter_feed_entries(feed.body), feed.etag or "", feed.modified or ""
+
+    def fetch_body(self, url, etag, modified, archive=False):
+        """
+        Conditionally download the feed, keeping a copy in storage until it has been
+        fully ingested. Returns the FeedResponse, or None if there is nothing to
+        ingest.
+        """
+        feed = fetch_feed(url, etag=etag, modified=modified)
+
+        if feed.status == 304:
+            self.stdout.write(self.style.SUCCESS(f"RSS fetched, but no new entries"))
+            return None
+
+        elif feed.status not in [200, 301]:
+            msg = f"RSS Feed status code: {feed.status}, not 200"
+            self.stdout.write(self.style.ERROR(msg))
+            rollbar.report_message(msg, "error")
+            return None
+
+        if archive:
+            name = archive_feed(feed.body, feed.etag, feed_suffix(url))
+            feed.body.seek(0)
+            self.stdout.write(self.style.SUCCESS(f"Archived RSS feed to {name}"))
+
+        # Keep a copy of the feed until it has been fully ingested, so that a run
+        # which times out can be resumed without downloading it again.
+        if default_storage.exists(feed_cache_name(url)):
+            default_storage.delete(feed_cache_name(url))
+        default_storage.save(feed_cache_name(url), File(feed.body))
+        feed.body.seek(0)
+        return feed
+
+    def write_batch(self, batch, update=True):
+        """
+        Write a batch of RSS entries, keyed by DOL ID, with one bulk insert for new
+        listings and one bulk update for existing ones whose RSS fields changed.
+        Unchanged listings, and existing ones when update is off, only have
+        last_seen bumped and delisted_at cleared, in a single UPDATE.
+        """
+        existing = existing_listings(batch.keys())
+        modified = now()
+        to_create = []
+        to_update = []
+        unchanged = []
+        skipped = []
+        operations = {}
+        for dol_id, (processed_count, defaults) in batch.items():
+            if dol_id not in existing:
+                to_create.append(Listing(dol_id=dol_id, **defaults))
+                operations[dol_id] = "Created"
+                continue
+
+            pk, rss_hash = existing[dol_id]
+            if not update:
+                skipped.append(dol_id)
+                operations[dol_id] = None
+            elif rss_hash == defaults["rss_hash"]:
+                unchanged.append(dol_id)
+                operations[dol_id] = "Unchanged"
+            else:
+                to_update.append(
+                    Listing(pk=pk, dol_id=dol_id, modified=modified, **defaults)
+                )
+                operations[dol_id] = "Updated"
+
+        Listing.objects.bulk_create(to_create)
+        Listing.objects.bulk_update(to_update, UPDATE_FIELDS)
+        # Listings left as they are are still in the feed, so they are seen again.
+        if unchanged or skipped:
+            Listing.objects.filter(dol_id__in=unchanged + skipped).update(
+                last_seen=modified.date(), delisted_at=None
             )
+        self.created_count += len(to_create)
+        self.updated_count += len(to_update)
+        self.unchanged_count += len(unchanged)
+
+        for dol_id, (processed_count, defaults) in batch.items():
+            if operations[dol_id] is None:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"{processed_count} skipped updating entry with title {defaults['title']} and id {dol_id}"
+                    )
+                )
+                continue
+            self.log_write(processed_count, operations[dol_id], dol_id, defaults)
+
+    def mark_delisted(self, feed_ids):
+        """
+        Set delisted_at on every active listing that is not in the feed, computed as
+        a set difference against the active IDs loaded in one query.
+        """
+        if not feed_ids:
+            # An empty feed is much more likely to be an upstream glitch than every
+            # listing having been taken down at once.
+            return
 
-        if rss_entries.get("modified", False):
-            StaticValue.objects.update_or_create(
-                key=MODIFIED_KEY, defaults={"value": rss_entries.get("modified", "")}
+        active_ids = Listing.objects.filter(delisted_at__isnull=True).values_list(
+            "dol_id", flat=True
+        )
+        delisted_ids = list(set(active_ids) - feed_ids)
+        delisted_at = now()
+        for i in range(0, len(delisted_ids), LOOKUP_CHUNK_SIZE):
+            Listing.objects.filter(
+                dol_id__in=delisted_ids[i : i + LOOKUP_CHUNK_SIZE]
+            ).update(delisted_at=delisted_at)
+        self.delisted_count = len(delisted_ids)
+
+    def log_write(self, processed_count, operation, dol_id, defaults):
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{processed_count} - {operation} entry with title {defaults['title']} and id {dol_id}"
             )
+        )
@@ -0,0 +1,185 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+
+from listings import datahub, http_client
+from listings.deadline import Deadline, add_deadline_argument
+from listings.models import Listing, StaticValue
+
+import rollbar
+
+PAGE_SIZE = datahub.MAX_TOP
+WATERMARK_KEY = "datahub_sync__watermark"
+
+
+class Command(BaseCommand):
+    help = "Page through the whole SeasonalJobs datahub index, saving scraped data for every listing in bulk"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--page_size",
+            type=int,
+            help=f"Number of records to request per API call, defaults to {PAGE_SIZE}",
+            default=PAGE_SIZE,
+        )
+        parser.add_argument(
+            "--max_pages",
+            type=int,
+            help="Max number of pages to request, defaults to no limit",
+            default=None,
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help=f"Only sync records with an {datahub.WATERMARK_FIELD} on or after the last one seen by a previous sync",
+        )
+        add_deadline_argument(parser)
+
+    def handle(self, *args, **options):
+        page_size = min(max(options.get("page_size") or PAGE_SIZE, 1), PAGE_SIZE)
+        max_pages = options.get("max_pages", None)
+        deadline = Deadline(options.get("deadline"))
+        throttled_before = http_client.throttle_count()
+
+        # A completed full sync also saves the watermark, to seed incremental syncs.
+        watermark = StaticValue.objects.filter(key=WATERMARK_KEY).first()
+        self.watermark = watermark.value if watermark else ""
+        since = self.watermark if options.get("incremental") else None
+        completed = False
+        if options.get("incremental") and not since:
+            self.stdout.write(
+                self.style.WARNING("No watermark saved yet, syncing the whole index")
+            )
+
+        self.updated_count = 0
+        self.unchanged_count = 0
+        self.unmatched_count = 0
+        api_calls = 0
+        last_record = None
+
+        while (max_pages is None or api_calls < max_pages) and deadline.allows():
+            result = datahub.search(datahub.page_payload(page_size, last_record, since))
+            api_calls += 1
+
+            if result.error:
+                msg = (
+                    f"API call failed for page {api_calls}, status code {result.response.status_code}"
+                    if result.error == "status"
+                    else f"Invalid JSON for page {api_calls}"
+                )
+                rollbar.report_message(msg, "error", extra_data={"page": api_calls})
+                self.stdout.write(self.style.ERROR(msg))
+                break
+
+            # Incremental pages come oldest first, so the watermark can be advanced
+            # page by page. A full sync is only up to date once it has finished.
+            self.save_page(result.records, save_watermark=bool(since))
+            deadline.done()
+
+            if len(result.records) < page_size:
+                completed = True
+                break
+            last_record = result.records[-1]
+
+        if completed and not since and self.watermark:
+            self.save_watermark()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Updated {self.updated_count} and skipped {self.unchanged_count} unchanged listings with {api_calls} API calls"
+            )
+        )
+        if deadline.reached:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"Ran out of time after {api_calls} pages, with more records left to sync"
+                )
+            )
+        self.stdout.write(http_client.rate_limit_summary(throttled_before))
+        if self.unmatched_count:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"{self.unmatched_count} datahub cases have no matching listing"
+                )
+            )
+
+    def save_watermark(self):
+        StaticValue.objects.update_or_create(
+            key=WATERMARK_KEY, defaults={"value": self.watermark}
+        )
+
+    def save_page(self, records, save_watermark=False):
+        """
+        Save one page of datahub records to their matching listings, and track the
+        latest watermark seen.
+        """
+        by_case_number = datahub.records_by_case_number(records)
+        by_case_number.pop(None, None)
+
+        timestamp = now()
+        changed = []
+        unchanged = []
+        matched = 0
+        for listing in Listing.objects.filter(
+            dol_id__in=list(by_case_number.keys())
+        ).only(
+            "id",
+            "dol_id",
+            "scraped",
+            "scraped_data",
+            "scraped_at",
+            "next_attempt_at",
+            "scrape_abandoned",
+        ):
+            matched += 1
+            previous_data = listing.scraped_data
+            listing.scraped_data = by_case_number[listing.dol_id]
+            listing.scraped_at = timestamp
+            listing.clean()
+            if (
+                listing.scraped
+                and listing.scraped_data == previous_data
+                and not listing.scrape_abandoned
+            ):
+                self.unchanged_count += 1
+                unchanged.append(listing)
+                continue
+
+            listing.scraped = True
+            # Clear any scrape_listings retry schedule, as record_scrape_attempt does.
+            listing.next_attempt_at = None
+            listing.scrape_abandoned = False
+            listing.modified = timestamp
+            changed.append(listing)
+
+        # Timestamps are ISO 8601 strings, so they sort correctly as text.
+        self.watermark = max(
+            [self.watermark]
+            + [
+                r[datahub.WATERMARK_FIELD]
+                for r in records
+                if r.get(datahub.WATERMARK_FIELD)
+            ]
+        )
+
+        with transaction.atomic():
+            Listing.objects.bulk_update(
+                changed,
+                [
+                    "scraped",
+                    "scraped_data",
+                    "scraped_at",
+                    "next_attempt_at",
+                    "scrape_abandoned",
+                    "modified",
+                ],
+            )
+            # Unchanged listings were still refreshed.
+            Listing.objects.filter(pk__in=[l.pk for l in unchanged]).update(
+                scraped_at=timestamp
+            )
+            if save_watermark and self.watermark:
+                self.save_watermark()
+
+        self.updated_count += len(changed)
+        self.unmatched_count += len(by_case_number) - matched
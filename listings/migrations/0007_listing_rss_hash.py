@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0006_delete_invalid_dol_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='rss_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
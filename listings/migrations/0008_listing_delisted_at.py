@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:56
+
+from datetime import date, datetime, time, timedelta
+
+from django.db import migrations, models
+
+
+def backfill_delisted_at(apps, schema_editor):
+    # Listings not seen in the feed since before yesterday were already treated as
+    # inactive by the export, so mark them as delisted the day after they were last seen.
+    Listing = apps.get_model("listings", "Listing")
+    stale_listings = Listing.objects.filter(
+        last_seen__lt=date.today() - timedelta(days=1)
+    ).only("pk", "last_seen")
+
+    batch = []
+    for l in stale_listings.iterator():
+        l.delisted_at = datetime.combine(l.last_seen + timedelta(days=1), time.min)
+        batch.append(l)
+        if len(batch) >= 1000:
+            Listing.objects.bulk_update(batch, ["delisted_at"])
+            batch = []
+    Listing.objects.bulk_update(batch, ["delisted_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0007_listing_rss_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='delisted_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_delisted_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0008_listing_delisted_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='staticvalue',
+            name='value',
+            field=models.TextField(blank=True),
+        ),
+    ]
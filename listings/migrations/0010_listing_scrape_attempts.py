@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0009_staticvalue_text_value'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='last_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='scrape_abandoned',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='scrape_attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(condition=models.Q(('scrape_abandoned', False), ('scraped', False)), fields=['next_attempt_at'], name='listing_scrape_due_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:13
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def backfill_scraped_at(apps, schema_editor):
+    # Scraped data is never changed after it is saved, so the last time a listing
+    # was modified is a close stand-in for when it was scraped.
+    Listing = apps.get_model("listings", "Listing")
+    Listing.objects.filter(scraped=True).update(
+        scraped_at=Coalesce("modified", "created")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0010_listing_scrape_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='scraped_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_scraped_at, migrations.RunPython.noop),
+    ]
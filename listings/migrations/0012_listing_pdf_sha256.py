@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0011_listing_scraped_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='pdf_sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0012_listing_pdf_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='pdf_abandoned',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='pdf_attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='pdf_next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
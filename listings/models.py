@@ -1,10 +1,25 @@
+from datetime import timedelta
+
 from django.db import models
+from django.db.models import Q
 from django.utils import timezone
 from django.conf import settings
 
 from dirtyfields import DirtyFieldsMixin
 
 
+def retry_delay(attempts):
+    """
+    Exponential backoff after the given number of failed attempts.
+    """
+    return timedelta(
+        seconds=min(
+            settings.SCRAPE_RETRY_DELAY * 2 ** (attempts - 1),
+            settings.SCRAPE_MAX_RETRY_DELAY,
+        )
+    )
+
+
 class CreatedModifiedMixin(DirtyFieldsMixin, models.Model):
     class Meta:
         abstract = True
@@ -25,7 +40,42 @@ class CreatedModifiedMixin(DirtyFieldsMixin, models.Model):
         return super().save(*args, **kwargs)
 
 
+class ListingQuerySet(models.QuerySet):
+    def due_for_scraping(self):
+        """
+        Unscraped listings that haven't been given up on and aren't backing off.
+        """
+        return self.filter(scraped=False, scrape_abandoned=False).filter(
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now())
+        )
+
+    def due_for_pdf(self):
+        """
+        Scraped listings without a job order PDF that haven't been given up on and
+        aren't backing off.
+        """
+        return (
+            self.filter(scraped=True, pdf_abandoned=False)
+            .filter(Q(pdf="") | Q(pdf__isnull=True))
+            .filter(
+                Q(pdf_next_attempt_at__isnull=True)
+                | Q(pdf_next_attempt_at__lte=timezone.now())
+            )
+        )
+
+
 class Listing(CreatedModifiedMixin, models.Model):
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                name="listing_scrape_due_idx",
+                condition=Q(scraped=False, scrape_abandoned=False),
+            )
+        ]
+
+    objects = ListingQuerySet.as_manager()
+
     # RSS listing fields
     title = models.CharField(max_length=255)
     link = models.URLField(unique=True)
@@ -34,15 +84,64 @@ class Listing(CreatedModifiedMixin, models.Model):
     pub_date = models.DateField()
     last_seen = models.DateField(auto_now_add=True)
     first_seen = models.DateField(auto_now_add=True)
+    # Fingerprint of the RSS fields above, used to skip rewriting unchanged entries
+    rss_hash = models.CharField(max_length=64, blank=True)
+    # Set when a listing drops out of the RSS feed, cleared if it reappears
+    delisted_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     # Has this listing been scraped?
     scraped = models.BooleanField(default=False)
+    # Scrape retry scheduling, with failing listings backing off exponentially until
+    # they are abandoned after SCRAPE_MAX_ATTEMPTS attempts
+    scrape_attempts = models.PositiveIntegerField(default=0)
+    last_attempt_at = models.DateTimeField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    scrape_abandoned = models.BooleanField(default=False)
 
     # Full job listing as scraped from SeasonalJobs API
     scraped_data = models.JSONField(null=True)
+    # When scraped_data was last fetched from the API
+    scraped_at = models.DateTimeField(null=True, blank=True)
 
     # Associated PDF
     pdf = models.FileField(upload_to="job_pdfs/", null=True)
+    # SHA-256 of the PDF's content, which it is stored under
+    pdf_sha256 = models.CharField(max_length=64, blank=True)
+    # PDF download retry scheduling, backing off like scrape attempts
+    pdf_attempts = models.PositiveIntegerField(default=0)
+    pdf_next_attempt_at = models.DateTimeField(null=True, blank=True)
+    pdf_abandoned = models.BooleanField(default=False)
+
+    def record_scrape_attempt(self, succeeded):
+        """
+        Record an attempt to scrape this listing, scheduling the next attempt if it
+        failed. Doesn't save the listing.
+        """
+        self.scrape_attempts += 1
+        self.last_attempt_at = timezone.now()
+        self.next_attempt_at = None
+        if succeeded:
+            # A listing given up on can still be scraped, e.g. from a record that
+            # another lookup returned.
+            self.scrape_abandoned = False
+            return
+
+        if self.scrape_attempts >= settings.SCRAPE_MAX_ATTEMPTS:
+            self.scrape_abandoned = True
+            return
+        self.next_attempt_at = self.last_attempt_at + retry_delay(self.scrape_attempts)
+
+    def record_pdf_failure(self):
+        """
+        Record a failed attempt to download this listing's job order PDF, scheduling
+        the next attempt. Doesn't save the listing.
+        """
+        self.pdf_attempts += 1
+        if self.pdf_attempts >= settings.SCRAPE_MAX_ATTEMPTS:
+            self.pdf_abandoned = True
+            self.pdf_next_attempt_at = None
+            return
+        self.pdf_next_attempt_at = timezone.now() + retry_delay(self.pdf_attempts)
 
     def clean(self):
         # Check that the url field in scraped_data is not invalid.
@@ -63,4 +162,4 @@ class StaticValue(models.Model):
     """
 
     key = models.CharField(max_length=255, primary_key=True)
-    value = models.CharField(max_length=255, blank=True)
+    value = models.TextField(blank=True)
@@ -0,0 +1,78 @@
+from collections import namedtuple
+from hashlib import sha256
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files import File
+
+from listings import http_client
+
+# DOL redirects here rather than returning a 404 for job orders it doesn't have.
+NOT_FOUND_URL = "https://seasonaljobs.dol.gov/system/404"
+
+# PDFs larger than this are spooled to disk rather than held in memory.
+SPOOL_MAX_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+PDF_DIR = "job_pdfs"
+
+# Result of a PDF download. body is a spooled temporary file holding the PDF and
+# sha256 the hex digest of its content, or both are None if the response wasn't a
+# job order PDF.
+PdfResponse = namedtuple("PdfResponse", ["status_code", "url", "body", "sha256"])
+
+
+def pdf_url(dol_id):
+    return f"{settings.JOB_ORDER_BASE_URL}{dol_id}"
+
+
+def download_pdf(dol_id):
+    """
+    Download the job order PDF for a listing, streaming it into a spooled temporary
+    file so that memory use doesn't grow with the size of the PDF. Safe to call from
+    worker threads.
+    """
+    response = http_client.get(pdf_url(dol_id), cache=True, stream=True)
+    try:
+        if not is_job_order_pdf(response):
+            return PdfResponse(response.status_code, response.url, None, None)
+
+        body = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        digest = sha256()
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            body.write(chunk)
+            digest.update(chunk)
+        body.seek(0)
+        return PdfResponse(response.status_code, response.url, body, digest.hexdigest())
+    finally:
+        # Hand the connection back to the pool.
+        response.close()
+
+
+def content_name(digest):
+    """
+    Storage name of a PDF with the given SHA-256 hex digest.
+    """
+    return f"{PDF_DIR}/sha256/{digest[:2]}/{digest[2:4]}/{digest}.pdf"
+
+
+def store_pdf(listing, job_order_pdf):
+    """
+    Point a listing at the stored copy of a downloaded PDF, uploading it only if no
+    PDF with the same content has been stored yet. Returns False if the listing
+    already had this PDF. Doesn't save the listing, and closes the PDF's body.
+    """
+    with job_order_pdf.body:
+        if listing.pdf and listing.pdf_sha256 == job_order_pdf.sha256:
+            return False
+
+        name = content_name(job_order_pdf.sha256)
+        if not listing.pdf.storage.exists(name):
+            name = listing.pdf.storage.save(name, File(job_order_pdf.body))
+
+    listing.pdf.name = name
+    listing.pdf_sha256 = job_order_pdf.sha256
+    return True
+
+
+def is_job_order_pdf(response):
+    return response.status_code in (200, 301) and response.url != NOT_FOUND_URL
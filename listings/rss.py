@@ -0,0 +1,185 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from hashlib import sha256
+from itertools import islice
+import gzip
+from tempfile import SpooledTemporaryFile
+from time import strftime
+from xml.etree.ElementTree import ParseError, iterparse
+import re
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils.text import slugify
+from django.utils.timezone import now
+
+from listings import http_client
+
+import feedparser
+from feedparser.datetimes import _parse_date
+from feedparser.sanitizer import _sanitize_html
+import rollbar
+
+DOL_ID_REGEX = re.compile(r"(H-[0-9\-]+)")
+
+# Feed bodies larger than this are spooled to disk rather than held in memory.
+SPOOL_MAX_SIZE = 5 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+SNAPSHOT_DIR = "rss/snapshots"
+
+RssEntry = namedtuple(
+    "RssEntry", ["dol_id", "link", "title", "description", "pub_date"]
+)
+FeedResponse = namedtuple("FeedResponse", ["status", "etag", "modified", "body"])
+
+
+def find_dol_id(link):
+    """
+    Return the DOL ID in an RSS entry link, or None if there isn't exactly one.
+    """
+    dol_ids = DOL_ID_REGEX.findall(link)
+    return dol_ids[0] if len(dol_ids) == 1 else None
+
+
+def fingerprint(link, title, description, pub_date):
+    """
+    Hash the RSS fields stored on a Listing, to detect entries that have changed.
+    """
+    content = "\x1f".join([link, title, description, str(pub_date)])
+    return sha256(content.encode("utf-8")).hexdigest()
+
+
+def feedparser_entries(rss_entries):
+    """
+    Yield RssEntry tuples from a feed already parsed by feedparser, with a None
+    pub_date for entries whose date is missing or unparseable.
+    """
+    for entry in rss_entries.get("entries", []):
+        link = entry.get("link", "")
+        published = entry.get("published_parsed")
+        yield RssEntry(
+            find_dol_id(link),
+            link,
+            entry.get("title", ""),
+            entry.get("description", ""),
+            strftime("%Y-%m-%d", published) if published else None,
+        )
+
+
+# The streaming parser uses feedparser's own date parsing and HTML sanitizing, so
+# that both parsers store (and fingerprint) the same values for an entry.
+
+
+def parse_pub_date(value):
+    """
+    Parse a date in any format feedparser accepts, normalized to UTC, or return
+    None if it can't be parsed.
+    """
+    pub_date = _parse_date(value.strip())
+    return strftime("%Y-%m-%d", pub_date) if pub_date else None
+
+
+def sanitize_html(value):
+    return _sanitize_html(value, "utf-8", "text/html")
+
+
+def stream_entries(body):
+    """
+    Incrementally parse an RSS 2.0 document, yielding one RssEntry per <item>.
+
+    Items are discarded as soon as they have been yielded, so memory use stays flat
+    regardless of the size of the feed. Raises ParseError on malformed XML.
+    """
+    parent = None
+    for event, element in iterparse(body, events=("start", "end")):
+        if event == "start":
+            if element.tag == "channel":
+                parent = element
+            continue
+
+        if element.tag != "item":
+            continue
+
+        link = (element.findtext("link") or "").strip()
+        yield RssEntry(
+            find_dol_id(link),
+            link,
+            (element.findtext("title") or "").strip(),
+            sanitize_html(element.findtext("description") or ""),
+            parse_pub_date(element.findtext("pubDate") or ""),
+        )
+
+        element.clear()
+        if parent is not None:
+            parent.remove(element)
+
+
+def iter_feed_entries(body):
+    """
+    Stream entries from a feed body, falling back to feedparser if the feed turns
+    out to be malformed part of the way through. Entries already yielded by the
+    streaming parser are not yielded again.
+    """
+    yielded = 0
+    try:
+        for entry in stream_entries(body):
+            yield entry
+            yielded += 1
+    except ParseError as e:
+        rollbar.report_message(
+            f"Malformed RSS feed, falling back to feedparser: {e}", "warning"
+        )
+        body.seek(0)
+        rss_entries = feedparser.parse(body.read())
+        yield from islice(feedparser_entries(rss_entries), yielded, None)
+
+
+def fetch_feed(url, etag=None, modified=None):
+    """
+    Conditionally download a feed, spooling the body to a temporary file.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+
+    response = http_client.get(url, headers=headers, stream=True)
+    body = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        body.write(chunk)
+    body.seek(0)
+
+    return FeedResponse(
+        response.status_code,
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+        body,
+    )
+
+
+def archive_feed(body, etag=None, label=""):
+    """
+    Save a gzipped copy of a feed body to storage, keyed by fetch time, an optional
+    label identifying the feed, and etag. Returns the storage name of the snapshot.
+    """
+    name = f"{SNAPSHOT_DIR}/{now():%Y%m%dT%H%M%S}{label}--{slugify(etag or '') or 'no-etag'}.xml.gz"
+    compressed = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+        for chunk in iter(lambda: body.read(CHUNK_SIZE), b""):
+            f.write(chunk)
+    compressed.seek(0)
+    return default_storage.save(name, File(compressed))
+
+
+@contextmanager
+def open_snapshot(name):
+    """
+    Open a feed snapshot from storage, decompressing it on the fly if gzipped.
+    """
+    with default_storage.open(name, "rb") as snapshot:
+        if name.endswith(".gz"):
+            with gzip.GzipFile(fileobj=snapshot, mode="rb") as body:
+                yield body
+        else:
+            yield snapshot
@@ -0,0 +1,33 @@
+from io import BytesIO, StringIO
+import tempfile
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+
+from listings.management.commands.benchmark_rss import write_synthetic_feed
+from listings.rss import stream_entries
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TestBenchmarkRSS(TestCase):
+    def test_generates_valid_feed(self):
+        body = BytesIO()
+        write_synthetic_feed(body, 1500)
+        body.seek(0)
+        entries = list(stream_entries(body))
+        self.assertEqual(len(entries), 1500)
+        self.assertEqual(len({entry.dol_id for entry in entries}), 1500)
+        self.assertTrue(all(entry.dol_id.startswith("H-") for entry in entries))
+
+    def test_reports_benchmark_results(self):
+        # Run inside the test database rather than creating another one.
+        with patch.object(connection.creation, "create_test_db"), patch.object(
+            connection.creation, "destroy_test_db"
+        ):
+            out = StringIO()
+            call_command("benchmark_rss", stdout=out, sizes=[10])
+        self.assertIn("10 entries (insert)", out.getvalue())
+        self.assertIn("10 entries (unchanged)", out.getvalue())
+        self.assertIn("entries/sec", out.getvalue())
@@ -0,0 +1,174 @@
+from hashlib import sha256
+from io import StringIO
+import tempfile
+from unittest.mock import patch
+
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.utils import timezone
+
+from listings.models import Listing
+from listings.pdfs import (
+    SPOOL_MAX_SIZE,
+    PdfResponse,
+    content_name,
+    pdf_url,
+    store_pdf,
+)
+
+import requests
+
+
+class FakeResponse(object):
+    # default response attributes
+    status_code = 200
+    content = b"Some content"
+    url = "https://seasonaljob.dol.gov/a-real-url"
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def failed_response(status_code=503, url="https://seasonaljob.dol.gov/a-real-url"):
+    response = FakeResponse()
+    response.status_code = status_code
+    response.url = url
+    return response
+
+
+@override_settings(
+    DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage",
+    MEDIA_ROOT=tempfile.mkdtemp(),
+)
+class TestFetchPdfs(TestCase):
+    def setUp(self):
+        for i in range(1, 4):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+                scraped=i < 3,
+            )
+
+    def test_fetches_pdfs_for_scraped_listings(self):
+        with patch("listings.http_client.get") as mock_request_get:
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("fetch_pdfs", stdout=out, concurrency=2)
+            self.assertEqual(mock_request_get.call_count, 2)
+            self.assertIn("Saved 2 and failed to fetch 0", out.getvalue())
+
+        self.assertEqual(Listing.objects.exclude(pdf="").count(), 2)
+        self.assertEqual(Listing.objects.get(dol_id="H-1").pdf.read(), b"Some content")
+
+        with patch("listings.http_client.get") as mock_request_get:
+            out = StringIO()
+            call_command("fetch_pdfs", stdout=out)
+            mock_request_get.assert_not_called()
+            self.assertIn("No job order PDFs left to fetch", out.getvalue())
+
+    def test_leaves_server_errors_for_a_later_run(self):
+        with patch("listings.http_client.get") as mock_request_get:
+            mock_request_get.side_effect = [
+                failed_response(),
+                requests.ConnectionError("Connection reset"),
+            ]
+            out = StringIO()
+            call_command("fetch_pdfs", stdout=out)
+            self.assertEqual(mock_request_get.call_count, 2)
+            self.assertIn("Saved 0 and failed to fetch 2", out.getvalue())
+        self.assertEqual(
+            Listing.objects.filter(pdf_next_attempt_at__isnull=False).count(), 2
+        )
+
+    def test_does_not_retry_missing_job_orders(self):
+        with patch("listings.http_client.get") as mock_request_get:
+            mock_request_get.return_value = failed_response(
+                200, "https://seasonaljobs.dol.gov/system/404"
+            )
+            out = StringIO()
+            call_command("fetch_pdfs", stdout=out)
+            self.assertEqual(mock_request_get.call_count, 2)
+            self.assertIn("Saved 0 and failed to fetch 2", out.getvalue())
+        self.assertEqual(Listing.objects.exclude(pdf="").count(), 0)
+
+    def test_backs_off_failed_pdfs(self):
+        with patch("listings.http_client.get") as mock_request_get:
+            mock_request_get.return_value = failed_response(
+                200, "https://seasonaljobs.dol.gov/system/404"
+            )
+            call_command("fetch_pdfs", stdout=StringIO(), max=1)
+        listing = Listing.objects.get(dol_id="H-2")
+        self.assertEqual(listing.pdf_attempts, 1)
+        self.assertGreater(listing.pdf_next_attempt_at, timezone.now())
+
+        # The newest listing is backing off, so the next run fetches the older one.
+        with patch("listings.http_client.get") as mock_request_get:
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("fetch_pdfs", stdout=out, max=1)
+            self.assertEqual(mock_request_get.call_args.args[0], pdf_url("H-1"))
+            self.assertIn("Saved 1 and failed to fetch 0", out.getvalue())
+
+    @override_settings(SCRAPE_MAX_ATTEMPTS=1)
+    def test_gives_up_on_failed_pdfs(self):
+        with patch("listings.http_client.get") as mock_request_get:
+            mock_request_get.return_value = failed_response(
+                200, "https://seasonaljobs.dol.gov/system/404"
+            )
+            out = StringIO()
+            call_command("fetch_pdfs", stdout=out)
+            self.assertIn("Giving up on the job order PDF", out.getvalue())
+        self.assertEqual(Listing.objects.filter(pdf_abandoned=True).count(), 2)
+        self.assertFalse(Listing.objects.due_for_pdf().exists())
+
+    def test_stops_when_out_of_time(self):
+        with patch("listings.http_client.get") as mock_request_get:
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("fetch_pdfs", stdout=out, deadline=-1)
+            mock_request_get.assert_not_called()
+            self.assertIn("Ran out of time with 2 job order PDFs", out.getvalue())
+
+    def test_streams_large_pdfs(self):
+        response = FakeResponse()
+        response.content = b"%PDF" + b"x" * (SPOOL_MAX_SIZE + 1)
+        with patch("listings.http_client.get") as mock_request_get:
+            mock_request_get.return_value = response
+            call_command("fetch_pdfs", stdout=StringIO(), max=1)
+            self.assertTrue(mock_request_get.call_args.kwargs["stream"])
+
+        listing = Listing.objects.exclude(pdf="").get()
+        self.assertEqual(listing.pdf.read(), response.content)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_stores_pdfs_by_content_hash(self):
+        digest = sha256(b"Some content").hexdigest()
+        with patch("listings.http_client.get") as mock_request_get, patch(
+            "django.core.files.storage.FileSystemStorage.save",
+            autospec=True,
+            side_effect=FileSystemStorage.save,
+        ) as mock_save:
+            mock_request_get.return_value = FakeResponse()
+            call_command("fetch_pdfs", stdout=StringIO())
+            # Both listings have the same PDF, so it is only uploaded once.
+            mock_save.assert_called_once()
+
+        name = f"job_pdfs/sha256/{digest[:2]}/{digest[2:4]}/{digest}.pdf"
+        self.assertEqual(content_name(digest), name)
+        for listing in Listing.objects.filter(scraped=True):
+            self.assertEqual(listing.pdf.name, name)
+            self.assertEqual(listing.pdf_sha256, digest)
+            self.assertEqual(listing.pdf.read(), b"Some content")
+
+        listing = Listing.objects.get(dol_id="H-1")
+        refetched = PdfResponse(200, FakeResponse.url, tempfile.TemporaryFile(), digest)
+        self.assertFalse(store_pdf(listing, refetched))
+        self.assertTrue(refetched.body.closed)
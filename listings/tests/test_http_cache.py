@@ -0,0 +1,113 @@
+import os
+import tempfile
+from unittest.mock import MagicMock, patch
+
+from django.test import SimpleTestCase, override_settings
+
+from listings import http_client
+from listings.http_cache import ResponseCache
+
+
+class FakeResponse(object):
+    def __init__(self, content=b"", status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.url = "https://api.seasonaljobs.dol.gov/job-order/H-1"
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class TestHttpCache(SimpleTestCase):
+    def setUp(self):
+        http_client._cache = None
+        self.cache_dir = tempfile.mkdtemp()
+        self.session = MagicMock()
+        settings_override = override_settings(
+            HTTP_CACHE_ENABLED=True, HTTP_CACHE_DIR=self.cache_dir
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        for patcher in [
+            patch("listings.http_client.get_session", return_value=self.session),
+            patch(
+                "listings.http_client.get_rate_limiter",
+                return_value=http_client.RateLimiter(1000, 1, 1000),
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, http_client, "_cache", None)
+
+    def test_serves_fresh_responses_from_cache(self):
+        self.session.request.return_value = FakeResponse(b"Some content")
+        first = http_client.get("https://example.com/pdf", cache=True, stream=True)
+        self.assertEqual(first.content, b"Some content")
+        second = http_client.get("https://example.com/pdf", cache=True, stream=True)
+        self.assertEqual(b"".join(second.iter_content(4)), b"Some content")
+        self.session.request.assert_called_once()
+
+        http_client.get("https://example.com/pdf")
+        self.assertEqual(self.session.request.call_count, 2)
+
+    def test_keys_searches_by_payload(self):
+        self.session.request.side_effect = lambda method, url, **kwargs: FakeResponse(
+            kwargs["json"]["search"].encode()
+        )
+        for search in ["a", "b", "a"]:
+            response = http_client.post(
+                "https://example.com/search", cache=True, json={"search": search}
+            )
+            self.assertEqual(response.content, search.encode())
+        self.assertEqual(self.session.request.call_count, 2)
+
+    @override_settings(HTTP_CACHE_TTL=0)
+    def test_revalidates_stale_responses(self):
+        self.session.request.return_value = FakeResponse(
+            b"Some content", headers={"ETag": '"v1"'}
+        )
+        http_client.get("https://example.com/pdf", cache=True)
+
+        self.session.request.return_value = FakeResponse(status_code=304)
+        response = http_client.get("https://example.com/pdf", cache=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"Some content")
+        self.assertEqual(
+            self.session.request.call_args.kwargs["headers"]["If-None-Match"], '"v1"'
+        )
+
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(self.cache_dir, ttl=60, max_size=10)
+        for key in ["a", "b"]:
+            cache.store(key, FakeResponse(b"12345")).close()
+        cache.get("a").body.close()
+        cache.store("c", FakeResponse(b"12345")).close()
+
+        for key in ["a", "c"]:
+            entry = cache.get(key)
+            self.assertIsNotNone(entry)
+            entry.body.close()
+        self.assertIsNone(cache.get("b"))
+        self.assertFalse(os.path.exists(cache.path("b")))
+
+    def test_serves_entries_evicted_after_lookup(self):
+        cache = ResponseCache(self.cache_dir, ttl=60, max_size=10)
+        cache.store("a", FakeResponse(b"12345")).close()
+        entry = cache.get("a")
+        # Another worker evicts the entry before its response is built.
+        cache.store("b", FakeResponse(b"1234567890")).close()
+        self.assertFalse(os.path.exists(cache.path("a")))
+        self.assertEqual(cache.response(entry).content, b"12345")
+
+    def test_closes_cached_bodies_once_read(self):
+        self.session.request.return_value = FakeResponse(b'{"value": []}')
+        http_client.post("https://example.com/search", cache=True, json={})
+        response = http_client.post("https://example.com/search", cache=True, json={})
+        self.session.request.assert_called_once()
+        self.assertEqual(response.json(), {"value": []})
+        self.assertTrue(response.raw.body.closed)
@@ -0,0 +1,89 @@
+from unittest.mock import MagicMock, patch
+
+from django.test import SimpleTestCase, override_settings
+
+from listings import http_client
+
+
+class TestHttpClient(SimpleTestCase):
+    def test_session_is_shared(self):
+        self.assertIs(http_client.get_session(), http_client.get_session())
+
+    @override_settings(HTTP_POOL_SIZE=4, HTTP_MAX_RETRIES=2)
+    def test_session_pools_and_retries(self):
+        session = http_client.build_session()
+        adapter = session.get_adapter("https://api.seasonaljobs.dol.gov/")
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertIn("POST", adapter.max_retries.allowed_methods)
+        self.assertIn("gzip", session.headers["Accept-Encoding"])
+
+    def test_rate_limiter_adapts_to_throttling(self):
+        limiter = http_client.RateLimiter(4, 1, 5)
+        limiter.throttle()
+        limiter.throttle()
+        self.assertEqual(limiter.rate, 1)
+        self.assertEqual(limiter.throttled, 2)
+        for i in range(50):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, 5)
+        self.assertIn("Request rate 5.0/s, throttled 2 times", limiter.summary())
+        # Each command reports only its own throttling, on a shared limiter.
+        throttled_before = limiter.throttled
+        limiter.throttle()
+        self.assertIn("throttled 1 times", limiter.summary(throttled_before))
+
+    def test_rate_limiter_waits_for_tokens(self):
+        limiter = http_client.RateLimiter(2, 1, 5)
+        with patch("listings.http_client.time") as mock_time:
+            clock = [100.0]
+            mock_time.monotonic.side_effect = lambda: clock[0]
+            mock_time.sleep.side_effect = lambda delay: clock.__setitem__(
+                0, clock[0] + delay
+            )
+            limiter.updated = clock[0]
+            limiter.throttle(retry_after=10)
+            limiter.acquire()
+            # Waits out the Retry-After, then refills a token at the reduced rate.
+            self.assertAlmostEqual(clock[0], 111.0)
+
+    def test_retry_after(self):
+        response = MagicMock(headers={"Retry-After": "3"})
+        self.assertEqual(http_client.retry_after(response), 3)
+        response.headers = {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}
+        self.assertEqual(http_client.retry_after(response), 0)
+        response.headers = {}
+        self.assertIsNone(http_client.retry_after(response))
+
+    @override_settings(HTTP_MAX_RETRIES=2)
+    def test_retries_throttled_requests(self):
+        throttled = MagicMock(status_code=429, headers={"Retry-After": "0"})
+        ok = MagicMock(status_code=200, headers={})
+        limiter = http_client.RateLimiter(1000, 1, 1000)
+        with patch("listings.http_client.get_session") as mock_session, patch(
+            "listings.http_client.get_rate_limiter", return_value=limiter
+        ):
+            mock_session.return_value.request.side_effect = [throttled, ok]
+            self.assertIs(http_client.get("https://example.com"), ok)
+            self.assertEqual(limiter.throttled, 1)
+
+            mock_session.return_value.request.side_effect = [throttled] * 3
+            self.assertIs(http_client.post("https://example.com"), throttled)
+            self.assertEqual(limiter.throttled, 4)
+
+    def test_only_speeds_up_on_healthy_responses(self):
+        limiter = http_client.RateLimiter(2, 1, 5)
+        with patch("listings.http_client.get_session") as mock_session, patch(
+            "listings.http_client.get_rate_limiter", return_value=limiter
+        ):
+            mock_session.return_value.request.return_value = MagicMock(
+                status_code=502, headers={}
+            )
+            http_client.get("https://example.com")
+            self.assertEqual(limiter.rate, 2)
+
+            mock_session.return_value.request.return_value = MagicMock(
+                status_code=200, headers={}
+            )
+            http_client.get("https://example.com")
+            self.assertGreater(limiter.rate, 2)
@@ -22,3 +22,27 @@ class TestListingModel(TestCase):
         test_listing.scraped_data["apply_url"] = "https://test.com"
         test_listing.clean()
         self.assertEqual(test_listing.scraped_data["apply_url"], "https://test.com")
+
+    @override_settings(
+        SCRAPE_RETRY_DELAY=60, SCRAPE_MAX_RETRY_DELAY=200, SCRAPE_MAX_ATTEMPTS=4
+    )
+    def test_schedules_scrape_retries(self):
+        test_listing = Listing()
+        delays = []
+        for i in range(3):
+            test_listing.record_scrape_attempt(succeeded=False)
+            delays.append(
+                (
+                    test_listing.next_attempt_at - test_listing.last_attempt_at
+                ).total_seconds()
+            )
+        self.assertEqual(delays, [60, 120, 200])
+        self.assertFalse(test_listing.scrape_abandoned)
+
+        test_listing.record_scrape_attempt(succeeded=False)
+        self.assertTrue(test_listing.scrape_abandoned)
+        self.assertIsNone(test_listing.next_attempt_at)
+        self.assertEqual(test_listing.scrape_attempts, 4)
+
+        test_listing.record_scrape_attempt(succeeded=True)
+        self.assertFalse(test_listing.scrape_abandoned)
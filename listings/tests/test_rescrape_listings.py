@@ -0,0 +1,112 @@
+from datetime import timedelta
+from io import StringIO
+import re
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.core.management import call_command
+from django.utils import timezone
+
+from listings.management.commands.rescrape_listings import priority
+from listings.models import Listing
+
+
+def lookup_ids(payload):
+    """
+    Case numbers looked up by a datahub lookup payload.
+    """
+    return (
+        re.match(r"search.in\(case_number, '(.*)', ','\)", payload["filter"])
+        .group(1)
+        .split(",")
+    )
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, records):
+        self.records = records
+
+    def json(self):
+        return {"value": self.records}
+
+
+class TestRescrapeListings(TestCase):
+    def create_listing(self, i, scraped_days_ago, seen_days_ago=0, **kwargs):
+        now = timezone.now()
+        listing = Listing.objects.create(
+            dol_id=f"H-{i}",
+            link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+            title=f"Test title #{i}",
+            description="Test description",
+            pub_date=now,
+            scraped=True,
+            scraped_data={"case_number": f"H-{i}", "case_status": "old"},
+            **kwargs,
+        )
+        Listing.objects.filter(pk=listing.pk).update(
+            scraped_at=now - timedelta(days=scraped_days_ago),
+            last_seen=(now - timedelta(days=seen_days_ago)).date(),
+        )
+        return listing
+
+    def test_priority(self):
+        now = timezone.now()
+        old = priority(now - timedelta(days=10), now.date(), None, now)
+        recent = priority(now - timedelta(days=2), now.date(), None, now)
+        unseen = priority(
+            now - timedelta(days=10), (now - timedelta(days=9)).date(), None, now
+        )
+        starting = priority(
+            now - timedelta(days=10),
+            now.date(),
+            str(now.date() + timedelta(days=1)),
+            now,
+        )
+        self.assertGreater(old, recent)
+        self.assertGreater(old, unseen)
+        self.assertGreater(starting, old)
+
+    def test_rescrapes_highest_priority_listings(self):
+        self.create_listing(1, scraped_days_ago=30)
+        self.create_listing(2, scraped_days_ago=2)
+        self.create_listing(3, scraped_days_ago=10)
+        self.create_listing(4, scraped_days_ago=0)
+        self.create_listing(5, scraped_days_ago=60, delisted_at=timezone.now())
+
+        def fake_post(url, json=None, **kwargs):
+            dol_ids = lookup_ids(json)
+            return FakeResponse(
+                [{"case_number": dol_id, "case_status": "new"} for dol_id in dol_ids]
+            )
+
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.side_effect = fake_post
+            out = StringIO()
+            call_command("rescrape_listings", stdout=out, max=2, lookup_batch=1)
+            self.assertEqual(
+                [
+                    lookup_ids(c.kwargs["json"])
+                    for c in mock_request_post.call_args_list
+                ],
+                [["H-1"], ["H-3"]],
+            )
+            self.assertIn("Refreshed 2 and found 0 unchanged listings", out.getvalue())
+
+        refreshed = Listing.objects.filter(scraped_data__case_status="new")
+        self.assertEqual(
+            set(refreshed.values_list("dol_id", flat=True)), {"H-1", "H-3"}
+        )
+        self.assertGreater(
+            Listing.objects.get(dol_id="H-1").scraped_at,
+            timezone.now() - timedelta(minutes=1),
+        )
+
+    def test_nothing_to_rescrape(self):
+        self.create_listing(1, scraped_days_ago=0)
+        with patch("listings.http_client.post") as mock_request_post:
+            out = StringIO()
+            call_command("rescrape_listings", stdout=out)
+            mock_request_post.assert_not_called()
+            self.assertIn("No listings need re-scraping", out.getvalue())
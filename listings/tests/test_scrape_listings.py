@@ -1,13 +1,31 @@
 from io import StringIO
+import re
+import tempfile
+import threading
 import time
 from unittest.mock import patch
 
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core.management import call_command
 from django.utils import timezone
 
 from listings.models import Listing, StaticValue
 
+import requests
+
+
+def lookup_ids(payload):
+    """
+    Case numbers looked up by a datahub lookup payload.
+    """
+    return (
+        re.match(r"search.in\(case_number, '(.*)', ','\)", payload["filter"])
+        .group(1)
+        .split(",")
+    )
+
 
 class FakeResponse(object):
     # default response attributes
@@ -15,6 +33,13 @@ class FakeResponse(object):
     content = b"Some content"
     url = "https://seasonaljob.dol.gov/a-real-url"
 
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def close(self):
+        pass
+
     def json(self):
         return {"value": [{"a_key": "a value", "case_number": "H-1"}]}
 
@@ -22,7 +47,10 @@ class FakeResponse(object):
         raise ValueError
 
 
-@override_settings(DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage")
+@override_settings(
+    DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage",
+    MEDIA_ROOT=tempfile.mkdtemp(),
+)
 class TestScrapeListings(TestCase):
     def setUp(self):
         # currently just creates 1 listing
@@ -36,7 +64,7 @@ class TestScrapeListings(TestCase):
             )
 
     def test_fails_on_invalid_status_code(self):
-        with patch("requests.post") as mock_request_post:
+        with patch("listings.http_client.post") as mock_request_post:
             mock_request_post.return_value = FakeResponse()
             mock_request_post.return_value.status_code = 403
             out = StringIO()
@@ -46,7 +74,7 @@ class TestScrapeListings(TestCase):
             self.assertIn("API call failed for listing", out.getvalue())
 
     def test_fails_on_invalid_json(self):
-        with patch("requests.post") as mock_request_post:
+        with patch("listings.http_client.post") as mock_request_post:
             mock_request_post.return_value = FakeResponse()
             mock_request_post.return_value.json = (
                 mock_request_post.return_value.invalid_json
@@ -58,8 +86,8 @@ class TestScrapeListings(TestCase):
             self.assertIn("Invalid JSON", out.getvalue())
 
     def test_successfully_scrapes_one_listing(self):
-        with patch("requests.post") as mock_request_post, patch(
-            "requests.get"
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
         ) as mock_request_get:
             mock_request_post.return_value = FakeResponse()
             mock_request_get.return_value = FakeResponse()
@@ -74,8 +102,8 @@ class TestScrapeListings(TestCase):
             self.assertEqual(l.scraped_data["a_key"], "a value")
 
     def test_successfully_saves_pdf(self):
-        with patch("requests.post") as mock_request_post, patch(
-            "requests.get"
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
         ) as mock_request_get:
             mock_request_post.return_value = FakeResponse()
             mock_request_get.return_value = FakeResponse()
@@ -87,3 +115,364 @@ class TestScrapeListings(TestCase):
             l = Listing.objects.get(dol_id="H-1")
             self.assertIsNotNone(l.pdf)
             self.assertEqual(l.pdf.readline(), b"Some content")
+
+    def test_scrapes_concurrently(self):
+        for i in range(2, 6):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+            )
+
+        def fake_post(url, json=None, **kwargs):
+            response = FakeResponse()
+            dol_id = lookup_ids(json)[0]
+            response.json = lambda: {"value": [{"case_number": dol_id}]}
+            return response
+
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get:
+            mock_request_post.side_effect = fake_post
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=5, concurrency=3)
+            self.assertEqual(mock_request_post.call_count, 5)
+            self.assertEqual(mock_request_get.call_count, 5)
+            self.assertEqual(Listing.objects.filter(scraped=True).count(), 5)
+            self.assertEqual(Listing.objects.exclude(pdf="").count(), 5)
+
+    def test_saves_mismatched_case_number_to_matching_listing(self):
+        Listing.objects.create(
+            dol_id="H-2",
+            link="http://seasonaljobs.dol.gov/jobs/H-2",
+            title="Test title #2",
+            description="Test description",
+            pub_date=timezone.now(),
+        )
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get:
+            mock_request_post.return_value = FakeResponse()
+            mock_request_post.return_value.json = lambda: {
+                "value": [{"case_number": "H-1"}]
+            }
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=1)
+            self.assertIn("Case number mismatch", out.getvalue())
+            self.assertTrue(Listing.objects.get(dol_id="H-1").scraped)
+            self.assertFalse(Listing.objects.get(dol_id="H-2").scraped)
+            mock_request_get.assert_called_once()
+            self.assertTrue(mock_request_get.call_args[0][0].endswith("H-1"))
+
+    def test_looks_up_listings_in_batches(self):
+        for i in range(2, 6):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+            )
+
+        def fake_post(url, json=None, **kwargs):
+            response = FakeResponse()
+            dol_ids = lookup_ids(json)
+            self.assertEqual(json["top"], len(dol_ids))
+            # Leave out one listing, to check records are matched by case number.
+            response.json = lambda: {
+                "value": (
+                    [{"case_number": dol_id} for dol_id in dol_ids[::-1]]
+                    if "H-3" not in dol_ids
+                    else [{"case_number": d} for d in dol_ids if d != "H-3"]
+                )
+            }
+            return response
+
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get:
+            mock_request_post.side_effect = fake_post
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=5, lookup_batch=3)
+            self.assertEqual(mock_request_post.call_count, 2)
+            self.assertIn("Scraped 4 listings with 2 API calls", out.getvalue())
+            self.assertEqual(
+                set(
+                    Listing.objects.filter(scraped=True).values_list(
+                        "dol_id", flat=True
+                    )
+                ),
+                {"H-1", "H-2", "H-4", "H-5"},
+            )
+
+    def test_skips_pdfs(self):
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get:
+            mock_request_post.return_value = FakeResponse()
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=1, skip_pdfs=True)
+            mock_request_get.assert_not_called()
+            self.assertTrue(Listing.objects.get(dol_id="H-1").scraped)
+
+    @override_settings(SCRAPE_MAX_ATTEMPTS=2)
+    def test_backs_off_listings_that_fail(self):
+        Listing.objects.create(
+            dol_id="H-2",
+            link="http://seasonaljobs.dol.gov/jobs/H-2",
+            title="Test title #2",
+            description="Test description",
+            pub_date=timezone.now(),
+        )
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.return_value = FakeResponse()
+            mock_request_post.return_value.status_code = 403
+            call_command("scrape_listings", stdout=StringIO(), max=1)
+
+            failed = Listing.objects.get(scrape_attempts=1)
+            self.assertGreater(failed.next_attempt_at, timezone.now())
+
+            # The failed listing isn't due, so the other one is tried next.
+            call_command("scrape_listings", stdout=StringIO(), max=1)
+            self.assertEqual(Listing.objects.filter(scrape_attempts=1).count(), 2)
+
+            call_command("scrape_listings", stdout=StringIO())
+            self.assertEqual(mock_request_post.call_count, 2)
+
+            Listing.objects.update(next_attempt_at=timezone.now())
+            out = StringIO()
+            call_command("scrape_listings", stdout=out)
+            self.assertIn(
+                "Gave up on 2 listings after 2 failed attempts", out.getvalue()
+            )
+            self.assertEqual(Listing.objects.filter(scrape_abandoned=True).count(), 2)
+
+            out = StringIO()
+            call_command("scrape_listings", stdout=out)
+            self.assertIn("No listings left to scrape", out.getvalue())
+
+    def test_reuses_records_returned_for_other_listings(self):
+        for i in range(2, 4):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+            )
+
+        def fake_post(url, json=None, **kwargs):
+            response = FakeResponse()
+            dol_id = lookup_ids(json)[0]
+            # The lookup for H-3 also returns H-1, which is further down the queue.
+            records = [{"case_number": dol_id}]
+            if dol_id == "H-3":
+                records.append({"case_number": "H-1"})
+            response.json = lambda: {"value": records}
+            return response
+
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get:
+            mock_request_post.side_effect = fake_post
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=3)
+            self.assertEqual(
+                [
+                    lookup_ids(c.kwargs["json"])
+                    for c in mock_request_post.call_args_list
+                ],
+                [["H-3"], ["H-2"]],
+            )
+            self.assertIn(
+                "Scraped 3 listings with 2 API calls, reusing 1 records",
+                out.getvalue(),
+            )
+            self.assertEqual(mock_request_get.call_count, 3)
+        self.assertEqual(Listing.objects.filter(scraped=True).count(), 3)
+
+    def test_writes_listings_once_in_bulk(self):
+        for i in range(2, 5):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+            )
+
+        def fake_post(url, json=None, **kwargs):
+            response = FakeResponse()
+            dol_id = lookup_ids(json)[0]
+            response.json = lambda: {"value": [{"case_number": dol_id}]}
+            return response
+
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get, CaptureQueriesContext(connection) as queries:
+            mock_request_post.side_effect = fake_post
+            mock_request_get.return_value = FakeResponse()
+            call_command("scrape_listings", stdout=StringIO(), max=4, batch_size=2)
+
+        updates = [q for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(Listing.objects.filter(scraped=True).count(), 4)
+        for listing in Listing.objects.all():
+            self.assertEqual(listing.pdf.read(), b"Some content")
+            self.assertIsNotNone(listing.modified)
+
+    def test_stops_at_deadline(self):
+        Listing.objects.create(
+            dol_id="H-2",
+            link="http://seasonaljobs.dol.gov/jobs/H-2",
+            title="Test title #2",
+            description="Test description",
+            pub_date=timezone.now(),
+        )
+
+        def fake_post(url, json=None, **kwargs):
+            response = FakeResponse()
+            dol_id = lookup_ids(json)[0]
+            response.json = lambda: {"value": [{"case_number": dol_id}]}
+            return response
+
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get, patch(
+            "listings.deadline.time", **{"monotonic.side_effect": [0, 10, 40]}
+        ):
+            mock_request_post.side_effect = fake_post
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=2, deadline=60)
+            mock_request_post.assert_called_once()
+            self.assertIn("Scraped 1 listings", out.getvalue())
+            self.assertIn("Ran out of time with 1 listings still due", out.getvalue())
+        self.assertEqual(Listing.objects.filter(scraped=True).count(), 1)
+
+    def test_keeps_scraped_data_when_requests_fail(self):
+        for i in range(2, 4):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+            )
+
+        def fake_post(url, json=None, **kwargs):
+            dol_id = lookup_ids(json)[0]
+            if dol_id == "H-2":
+                raise requests.ConnectionError("Connection reset")
+            response = FakeResponse()
+            response.json = lambda: {"value": [{"case_number": dol_id}]}
+            return response
+
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get:
+            mock_request_post.side_effect = fake_post
+            mock_request_get.side_effect = requests.ConnectionError("Connection reset")
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=3, concurrency=2)
+            self.assertIn(
+                "API call failed for listing, Connection reset", out.getvalue()
+            )
+            self.assertIn("Failed job order PDF request", out.getvalue())
+
+        self.assertEqual(
+            set(Listing.objects.filter(scraped=True).values_list("dol_id", flat=True)),
+            {"H-1", "H-3"},
+        )
+        self.assertEqual(Listing.objects.exclude(pdf="").count(), 0)
+        failed = Listing.objects.get(dol_id="H-2")
+        self.assertEqual(failed.scrape_attempts, 1)
+        self.assertIsNotNone(failed.next_attempt_at)
+
+    def test_uses_records_returned_while_lookup_in_flight(self):
+        for i in range(2, 4):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+            )
+        h3_returned = threading.Event()
+
+        def fake_post(url, json=None, **kwargs):
+            response = FakeResponse()
+            dol_id = lookup_ids(json)[0]
+            records = [{"case_number": dol_id}]
+            if dol_id == "H-3":
+                # H-3's search also returns H-2, whose own search misses it.
+                records.append({"case_number": "H-2"})
+                h3_returned.set()
+            elif dol_id == "H-2":
+                h3_returned.wait(5)
+                time.sleep(0.1)
+                records = []
+            response.json = lambda: {"value": records}
+            return response
+
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get:
+            mock_request_post.side_effect = fake_post
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=3, concurrency=3)
+            self.assertEqual(mock_request_post.call_count, 3)
+            self.assertIn("Scraped 3 listings", out.getvalue())
+
+        listing = Listing.objects.get(dol_id="H-2")
+        self.assertTrue(listing.scraped)
+        self.assertIsNone(listing.next_attempt_at)
+
+    @override_settings(SCRAPE_MAX_ATTEMPTS=1)
+    def test_unabandons_listings_scraped_from_another_lookup(self):
+        for i in range(2, 4):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+            )
+        h2_returned = threading.Event()
+
+        def fake_post(url, json=None, **kwargs):
+            response = FakeResponse()
+            dol_id = lookup_ids(json)[0]
+            records = [{"case_number": dol_id}]
+            if dol_id == "H-2":
+                # H-2's own search misses it, and it is given up on...
+                records = []
+                h2_returned.set()
+            elif dol_id == "H-3":
+                # ...before H-3's search returns it.
+                h2_returned.wait(5)
+                time.sleep(0.1)
+                records.append({"case_number": "H-2"})
+            response.json = lambda: {"value": records}
+            return response
+
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.http_client.get"
+        ) as mock_request_get:
+            mock_request_post.side_effect = fake_post
+            mock_request_get.return_value = FakeResponse()
+            out = StringIO()
+            call_command("scrape_listings", stdout=out, max=3, concurrency=3)
+            self.assertIn("Giving up on scraping listing ID H-2", out.getvalue())
+            self.assertNotIn("Gave up on", out.getvalue())
+
+        listing = Listing.objects.get(dol_id="H-2")
+        self.assertTrue(listing.scraped)
+        self.assertFalse(listing.scrape_abandoned)
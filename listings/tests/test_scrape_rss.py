@@ -1,16 +1,51 @@
 from io import StringIO
+import json
+import re
+import tempfile
 import time
 from unittest.mock import patch
 
-from django.test import TestCase
+from django.db import DatabaseError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core.management import call_command
+from django.utils import timezone
 
 from listings.models import Listing, StaticValue
 
 
+def make_feed(count, start=1):
+    items = "".join(f"""
+        <item>
+            <title>Test title #{n}</title>
+            <link>http://seasonaljobs.dol.gov/jobs/H-{n}</link>
+            <description>Test description</description>
+            <pubDate>Mon, 08 Jun 2020 00:00:00 GMT</pubDate>
+        </item>""" for n in range(start, start + count))
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>Jobs</title>{items}
+</channel></rss>""".encode()
+
+
+class FakeFeedResponse(object):
+    status_code = 200
+
+    def __init__(self, content, headers=None):
+        self.content = content
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
 class TestScrapeRSS(TestCase):
     def test_fails_on_bozo_error(self):
-        with patch("feedparser.parse") as mock_parse:
+        with patch("listings.http_client.get") as mock_get, patch(
+            "feedparser.parse"
+        ) as mock_parse:
+            mock_get.return_value = FakeFeedResponse(b"")
             mock_parse.return_value = {"bozo": 1, "bozo_exception": "Test exception"}
             out = StringIO()
             self.assertFalse(call_command("scrape_rss", stdout=out))
@@ -19,19 +54,22 @@ class TestScrapeRSS(TestCase):
             self.assertEqual(Listing.objects.count(), 0)
 
     def test_fails_on_invalid_status_code(self):
-        with patch("feedparser.parse") as mock_parse:
-            mock_parse.return_value = {
-                "status": 403,
-            }
+        with patch("listings.http_client.get") as mock_get, patch(
+            "feedparser.parse"
+        ) as mock_parse:
+            mock_get.return_value = FakeFeedResponse(b"")
+            mock_get.return_value.status_code = 403
             out = StringIO()
             call_command("scrape_rss", stdout=out)
             self.assertIn("403", out.getvalue())
             self.assertEqual(Listing.objects.count(), 0)
 
     def test_successfully_handles_no_new_entries(self):
-        with patch("feedparser.parse") as mock_parse:
+        with patch("listings.http_client.get") as mock_get, patch(
+            "feedparser.parse"
+        ) as mock_parse:
+            mock_get.return_value = FakeFeedResponse(b"")
             mock_parse.return_value = {
-                "status": 200,
                 "version": "",
             }
             out = StringIO()
@@ -40,7 +78,10 @@ class TestScrapeRSS(TestCase):
             self.assertEqual(Listing.objects.count(), 0)
 
     def test_successfully_scrapes_entries(self):
-        with patch("feedparser.parse") as mock_parse:
+        with patch("listings.http_client.get") as mock_get, patch(
+            "feedparser.parse"
+        ) as mock_parse:
+            mock_get.return_value = FakeFeedResponse(b"")
             test_entries = [
                 {
                     "link": f"http://seasonaljobs.dol.gov/jobs/H-{n}",
@@ -51,7 +92,6 @@ class TestScrapeRSS(TestCase):
                 for n in range(1, 6)
             ]
             mock_parse.return_value = {
-                "status": 200,
                 "version": "test",
                 "entries": test_entries,
             }
@@ -62,13 +102,19 @@ class TestScrapeRSS(TestCase):
             self.assertEqual(Listing.objects.count(), 5)
 
     def test_saves_modified_date_and_etag(self):
-        with patch("feedparser.parse") as mock_parse:
+        with patch("listings.http_client.get") as mock_get, patch(
+            "feedparser.parse"
+        ) as mock_parse:
+            mock_get.return_value = FakeFeedResponse(
+                b"",
+                headers={
+                    "ETag": "6c132-941-ad7e3080",
+                    "Last-Modified": "Fri, 11 Jun 2012 23:00:34 GMT",
+                },
+            )
             mock_parse.return_value = {
-                "status": 200,
                 "version": "test",
                 "entries": [],
-                "etag": "6c132-941-ad7e3080",
-                "modified": "Fri, 11 Jun 2012 23:00:34 GMT",
             }
             out = StringIO()
             call_command("scrape_rss", stdout=out)
@@ -77,3 +123,403 @@ class TestScrapeRSS(TestCase):
             modified = StaticValue.objects.get(key="jobs_rss__modified")
             self.assertEqual(etag.value, "6c132-941-ad7e3080")
             self.assertEqual(modified.value, "Fri, 11 Jun 2012 23:00:34 GMT")
+
+    def test_updates_existing_entries_in_batches(self):
+        Listing.objects.create(
+            dol_id="H-1",
+            link="http://seasonaljobs.dol.gov/jobs/H-1",
+            title="Old title",
+            description="Old description",
+            pub_date="2020-01-01",
+        )
+        with patch("listings.http_client.get") as mock_get, patch(
+            "feedparser.parse"
+        ) as mock_parse:
+            mock_get.return_value = FakeFeedResponse(b"")
+            test_entries = [
+                {
+                    "link": f"http://seasonaljobs.dol.gov/jobs/H-{n}",
+                    "title": f"Test title #{n}",
+                    "description": "Test description",
+                    "published_parsed": time.localtime(),
+                }
+                for n in range(1, 6)
+            ]
+            mock_parse.return_value = {
+                "version": "test",
+                "entries": test_entries,
+            }
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, batch_size=2)
+            self.assertIn("Updated entry with title Test title #1", out.getvalue())
+            self.assertIn(
+                "Created 4, updated 1 and skipped 0 unchanged entries", out.getvalue()
+            )
+            self.assertEqual(Listing.objects.count(), 5)
+            self.assertEqual(Listing.objects.get(dol_id="H-1").title, "Test title #1")
+
+    def test_resumes_feedparser_run_without_refetching(self):
+        with patch("listings.http_client.get") as mock_get, patch(
+            "listings.deadline.time", **{"monotonic.side_effect": [0, 10, 40]}
+        ):
+            mock_get.return_value = FakeFeedResponse(
+                make_feed(5), headers={"ETag": "feed-etag"}
+            )
+            call_command("scrape_rss", stdout=StringIO(), batch_size=2, deadline=60)
+        self.assertEqual(Listing.objects.count(), 2)
+
+        with patch("listings.http_client.get") as mock_get:
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, batch_size=2)
+            mock_get.assert_not_called()
+
+        self.assertIn("Resuming RSS ingestion after entry 2", out.getvalue())
+        self.assertEqual(Listing.objects.count(), 5)
+        self.assertEqual(
+            StaticValue.objects.get(key="jobs_rss__etag").value, "feed-etag"
+        )
+
+    def test_streams_entries(self):
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(
+                make_feed(5), headers={"ETag": "stream-etag"}
+            )
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, stream=True)
+            self.assertIn("Test title #5", out.getvalue())
+            self.assertEqual(Listing.objects.count(), 5)
+            self.assertEqual(
+                str(Listing.objects.get(dol_id="H-1").pub_date), "2020-06-08"
+            )
+            etag = StaticValue.objects.get(key="jobs_rss__etag")
+            self.assertEqual(etag.value, "stream-etag")
+
+    def test_stream_handles_not_modified(self):
+        StaticValue.objects.create(key="jobs_rss__etag", value="stream-etag")
+        with patch("listings.http_client.get") as mock_get:
+            response = FakeFeedResponse(b"")
+            response.status_code = 304
+            mock_get.return_value = response
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, stream=True)
+            self.assertEqual(
+                mock_get.call_args[1]["headers"]["If-None-Match"], "stream-etag"
+            )
+            self.assertIn("no new entries", out.getvalue())
+            self.assertEqual(Listing.objects.count(), 0)
+
+    def test_stream_falls_back_to_feedparser_on_malformed_feed(self):
+        malformed = make_feed(3).replace(b"Test title #2", b"Test &bad; title #2")
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(malformed)
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, stream=True)
+            self.assertEqual(Listing.objects.count(), 3)
+            self.assertIn(
+                "Created 3, updated 0 and skipped 0 unchanged entries", out.getvalue()
+            )
+
+    def test_stream_matches_feedparser(self):
+        feed = (
+            make_feed(3)
+            .replace(
+                b"Test description",
+                b"&lt;p onclick='x()'&gt;Test &lt;b&gt;description&lt;/b&gt;&lt;/p&gt;",
+            )
+            .replace(b"Mon, 08 Jun 2020 00:00:00 GMT", b"2020-06-08T00:00:00Z")
+        )
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(feed)
+            call_command("scrape_rss", stdout=StringIO(), stream=True)
+
+        listing = Listing.objects.get(dol_id="H-1")
+        self.assertEqual(listing.description, "<p>Test <b>description</b></p>")
+        self.assertEqual(str(listing.pub_date), "2020-06-08")
+
+        # Switching parsers doesn't rewrite anything.
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(feed)
+            out = StringIO()
+            call_command("scrape_rss", stdout=out)
+            self.assertIn(
+                "Created 0, updated 0 and skipped 3 unchanged entries", out.getvalue()
+            )
+
+    def test_skips_entries_without_a_date(self):
+        feed = make_feed(3).replace(
+            b"<pubDate>Mon, 08 Jun 2020 00:00:00 GMT</pubDate>",
+            b"<pubDate>Not a date</pubDate>",
+            1,
+        )
+        for stream in [True, False]:
+            with patch("listings.http_client.get") as mock_get:
+                mock_get.return_value = FakeFeedResponse(feed)
+                call_command("scrape_rss", stdout=StringIO(), stream=stream)
+            self.assertEqual(Listing.objects.count(), 2)
+            self.assertFalse(Listing.objects.filter(dol_id="H-1").exists())
+
+    def test_skips_unchanged_entries(self):
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(make_feed(3))
+            call_command("scrape_rss", stdout=StringIO(), stream=True)
+
+        Listing.objects.update(last_seen="2020-01-01")
+        changed_feed = make_feed(3).replace(b"Test title #3", b"New title #3")
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(changed_feed)
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, stream=True)
+
+        self.assertIn("Unchanged entry with title Test title #1", out.getvalue())
+        self.assertIn("Updated entry with title New title #3", out.getvalue())
+        self.assertIn("updated 1 and skipped 2 unchanged entries", out.getvalue())
+        self.assertFalse(Listing.objects.filter(last_seen="2020-01-01").exists())
+        self.assertIsNone(Listing.objects.get(dol_id="H-1").modified)
+        self.assertIsNotNone(Listing.objects.get(dol_id="H-3").modified)
+
+    def test_skip_update_leaves_existing_entries(self):
+        Listing.objects.create(
+            dol_id="H-1",
+            link="http://seasonaljobs.dol.gov/jobs/H-1",
+            title="Old title",
+            description="Old description",
+            pub_date="2020-01-01",
+            delisted_at=timezone.now(),
+        )
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(make_feed(3))
+            out = StringIO()
+            with CaptureQueriesContext(connection) as queries:
+                call_command("scrape_rss", stdout=out, stream=True, skip_update=True)
+        inserts = [q for q in queries if q["sql"].startswith("INSERT")]
+        self.assertEqual(len(inserts), 1)
+        self.assertIn(
+            "1 skipped updating entry with title Test title #1", out.getvalue()
+        )
+        self.assertIn("Created 2, updated 0", out.getvalue())
+        listing = Listing.objects.get(dol_id="H-1")
+        self.assertEqual(listing.title, "Old title")
+        # Back in the feed, so no longer delisted.
+        self.assertIsNone(listing.delisted_at)
+
+    def test_does_not_save_etag_if_a_batch_fails(self):
+        bulk_create = Listing.objects.bulk_create
+        calls = []
+
+        def failing_bulk_create(objs):
+            calls.append(objs)
+            if len(calls) == 3:
+                raise DatabaseError("Test failure")
+            return bulk_create(objs)
+
+        with patch("listings.http_client.get") as mock_get, patch.object(
+            Listing.objects, "bulk_create", side_effect=failing_bulk_create
+        ):
+            mock_get.return_value = FakeFeedResponse(
+                make_feed(5), headers={"ETag": "stream-etag"}
+            )
+            with self.assertRaises(DatabaseError):
+                call_command("scrape_rss", stdout=StringIO(), stream=True, batch_size=2)
+
+        self.assertEqual(Listing.objects.count(), 4)
+        self.assertFalse(StaticValue.objects.filter(key="jobs_rss__etag").exists())
+
+    def test_resumes_from_checkpoint_without_refetching(self):
+        bulk_create = Listing.objects.bulk_create
+        calls = []
+
+        def failing_bulk_create(objs):
+            calls.append(objs)
+            if len(calls) == 3:
+                raise DatabaseError("Test failure")
+            return bulk_create(objs)
+
+        with patch("listings.http_client.get") as mock_get, patch.object(
+            Listing.objects, "bulk_create", side_effect=failing_bulk_create
+        ):
+            mock_get.return_value = FakeFeedResponse(
+                make_feed(5), headers={"ETag": "stream-etag"}
+            )
+            with self.assertRaises(DatabaseError):
+                call_command("scrape_rss", stdout=StringIO(), stream=True, batch_size=2)
+
+        checkpoint = StaticValue.objects.get(key="jobs_rss__checkpoint")
+        self.assertEqual(json.loads(checkpoint.value)["index"], 4)
+
+        with patch("listings.http_client.get") as mock_get:
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, stream=True, batch_size=2)
+            mock_get.assert_not_called()
+
+        self.assertIn("Resuming RSS ingestion after entry 4", out.getvalue())
+        self.assertIn("Created 1, updated 0", out.getvalue())
+        self.assertEqual(Listing.objects.count(), 5)
+        self.assertEqual(
+            StaticValue.objects.get(key="jobs_rss__etag").value, "stream-etag"
+        )
+        self.assertFalse(
+            StaticValue.objects.filter(key="jobs_rss__checkpoint").exists()
+        )
+
+    def test_stops_at_deadline_and_resumes(self):
+        with patch("listings.http_client.get") as mock_get, patch(
+            "listings.deadline.time", **{"monotonic.side_effect": [0, 10, 40]}
+        ):
+            mock_get.return_value = FakeFeedResponse(
+                make_feed(5), headers={"ETag": "stream-etag"}
+            )
+            out = StringIO()
+            call_command(
+                "scrape_rss", stdout=out, stream=True, batch_size=2, deadline=60
+            )
+
+        self.assertIn(
+            "Ran out of time with the feed ingested up to entry 2", out.getvalue()
+        )
+        self.assertEqual(Listing.objects.count(), 2)
+        self.assertFalse(StaticValue.objects.filter(key="jobs_rss__etag").exists())
+
+        with patch("listings.http_client.get") as mock_get:
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, stream=True, batch_size=2)
+            mock_get.assert_not_called()
+
+        self.assertIn("Resuming RSS ingestion after entry 2", out.getvalue())
+        self.assertEqual(Listing.objects.count(), 5)
+        self.assertEqual(
+            StaticValue.objects.get(key="jobs_rss__etag").value, "stream-etag"
+        )
+
+    def test_marks_listings_missing_from_feed_as_delisted(self):
+        for n in (9, 10):
+            Listing.objects.create(
+                dol_id=f"H-{n}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{n}",
+                title=f"Old title #{n}",
+                description="Old description",
+                pub_date="2020-01-01",
+                delisted_at=timezone.now() if n == 10 else None,
+            )
+        Listing.objects.create(
+            dol_id="H-1",
+            link="http://seasonaljobs.dol.gov/jobs/H-1",
+            title="Old title #1",
+            description="Old description",
+            pub_date="2020-01-01",
+            delisted_at=timezone.now(),
+        )
+
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(make_feed(3))
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, stream=True)
+
+        self.assertIn("Marked 1 listings no longer in the feed", out.getvalue())
+        self.assertEqual(
+            set(
+                Listing.objects.filter(delisted_at__isnull=True).values_list(
+                    "dol_id", flat=True
+                )
+            ),
+            {"H-1", "H-2", "H-3"},
+        )
+
+    def test_does_not_mark_delisted_on_partial_run(self):
+        Listing.objects.create(
+            dol_id="H-9",
+            link="http://seasonaljobs.dol.gov/jobs/H-9",
+            title="Old title",
+            description="Old description",
+            pub_date="2020-01-01",
+        )
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(make_feed(3))
+            call_command("scrape_rss", stdout=StringIO(), stream=True, max=2)
+
+        self.assertIsNone(Listing.objects.get(dol_id="H-9").delisted_at)
+
+    def test_archives_feed_and_replays_snapshot(self):
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.return_value = FakeFeedResponse(
+                make_feed(3), headers={"ETag": '"6c132-941"'}
+            )
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, archive=True)
+
+        self.assertIn("Archived RSS feed to rss/snapshots/", out.getvalue())
+        snapshot = re.search(r"(rss/snapshots/\S+--6c132-941\.xml\.gz)", out.getvalue())
+        self.assertIsNotNone(snapshot)
+
+        Listing.objects.all().delete()
+        StaticValue.objects.all().delete()
+        with patch("listings.http_client.get") as mock_get:
+            out = StringIO()
+            call_command("scrape_rss", stdout=out, replay=snapshot.group(1))
+            mock_get.assert_not_called()
+
+        self.assertIn("Created 3, updated 0", out.getvalue())
+        self.assertEqual(Listing.objects.count(), 3)
+        self.assertFalse(StaticValue.objects.exists())
+
+    def test_merges_multiple_feeds(self):
+        main_feed = "https://seasonaljobs.dol.gov/job_rss.xml"
+        extra_feed = "https://example.com/h2b_rss.xml"
+        responses = {
+            main_feed: FakeFeedResponse(make_feed(3), headers={"ETag": "main-etag"}),
+            extra_feed: FakeFeedResponse(
+                make_feed(3, start=3).replace(b"Test title #3", b"Extra title #3"),
+                headers={"ETag": "extra-etag"},
+            ),
+        }
+        with patch("listings.http_client.get") as mock_get:
+            mock_get.side_effect = lambda url, **kwargs: responses[url]
+            out = StringIO()
+            call_command(
+                "scrape_rss", stdout=out, stream=True, feed=[main_feed, extra_feed]
+            )
+
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertIn("Created 5, updated 0", out.getvalue())
+        self.assertEqual(Listing.objects.get(dol_id="H-3").title, "Extra title #3")
+        self.assertEqual(
+            StaticValue.objects.get(key="jobs_rss__etag").value, "main-etag"
+        )
+        extra_etags = StaticValue.objects.filter(
+            key__startswith="jobs_rss__etag__"
+        ).values_list("value", flat=True)
+        self.assertEqual(list(extra_etags), ["extra-etag"])
+
+    def test_resumes_when_one_feed_is_unchanged(self):
+        main_feed = "https://seasonaljobs.dol.gov/job_rss.xml"
+        extra_feed = "https://example.com/h2b_rss.xml"
+        not_modified = FakeFeedResponse(b"")
+        not_modified.status_code = 304
+        responses = {
+            main_feed: FakeFeedResponse(make_feed(5), headers={"ETag": "main-etag"}),
+            extra_feed: not_modified,
+        }
+        with patch("listings.http_client.get") as mock_get, patch(
+            "listings.deadline.time", **{"monotonic.side_effect": [0, 10, 40]}
+        ):
+            mock_get.side_effect = lambda url, **kwargs: responses[url]
+            call_command(
+                "scrape_rss",
+                stdout=StringIO(),
+                batch_size=2,
+                deadline=60,
+                feed=[main_feed, extra_feed],
+            )
+        self.assertEqual(Listing.objects.count(), 2)
+
+        with patch("listings.http_client.get") as mock_get:
+            out = StringIO()
+            call_command(
+                "scrape_rss", stdout=out, batch_size=2, feed=[main_feed, extra_feed]
+            )
+            mock_get.assert_not_called()
+
+        self.assertIn("Resuming RSS ingestion after entry 2", out.getvalue())
+        self.assertEqual(Listing.objects.count(), 5)
+        self.assertEqual(
+            StaticValue.objects.get(key="jobs_rss__etag").value, "main-etag"
+        )
@@ -0,0 +1,200 @@
+from io import StringIO
+import re
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.core.management import call_command
+from django.utils import timezone
+
+from listings.management.commands.sync_datahub import WATERMARK_KEY
+from listings.models import Listing, StaticValue
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, records):
+        self.records = records
+
+    def json(self):
+        return {"value": self.records}
+
+
+class TestSyncDatahub(TestCase):
+    def setUp(self):
+        for i in range(1, 5):
+            Listing.objects.create(
+                dol_id=f"H-{i}",
+                link=f"http://seasonaljobs.dol.gov/jobs/H-{i}",
+                title=f"Test title #{i}",
+                description="Test description",
+                pub_date=timezone.now(),
+            )
+
+    def fake_post(self, records):
+        def post(url, json=None, **kwargs):
+            # Evaluate just enough of the filter to page like the API does.
+            page_filter = json.get("filter", "")
+            incremental = json["orderby"].startswith("accepted_date")
+
+            def key(record):
+                if incremental:
+                    return (record["accepted_date"], record["case_number"])
+                return (record["case_number"],)
+
+            since = re.match(r"accepted_date ge (\S+)", page_filter)
+            after = re.search(
+                r"(?:accepted_date gt (\S+) or .*)?case_number gt '([^']*)'",
+                page_filter,
+            )
+            page = sorted(records, key=key)
+            if since:
+                page = [r for r in page if r["accepted_date"] >= since.group(1)]
+            if after:
+                after_key = after.groups() if incremental else (after.group(2),)
+                page = [r for r in page if key(r) > after_key]
+            return FakeResponse(page[: json["top"]])
+
+        return post
+
+    def test_pages_through_index(self):
+        records = [{"case_number": f"H-{i}", "apply_url": "N/A"} for i in range(1, 6)]
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.side_effect = self.fake_post(records)
+            out = StringIO()
+            call_command("sync_datahub", stdout=out, page_size=2)
+            self.assertEqual(mock_request_post.call_count, 3)
+            self.assertEqual(
+                [
+                    c.kwargs["json"].get("filter")
+                    for c in mock_request_post.call_args_list
+                ],
+                [None, "case_number gt 'H-2'", "case_number gt 'H-4'"],
+            )
+            self.assertNotIn("skip", mock_request_post.call_args.kwargs["json"])
+            self.assertIn(
+                "Updated 4 and skipped 0 unchanged listings with 3 API calls",
+                out.getvalue(),
+            )
+            self.assertIn("1 datahub cases have no matching listing", out.getvalue())
+
+        self.assertEqual(Listing.objects.filter(scraped=True).count(), 4)
+        listing = Listing.objects.get(dol_id="H-3")
+        self.assertEqual(listing.scraped_data["apply_url"], "")
+        self.assertIsNotNone(listing.modified)
+
+    def test_clears_scrape_retry_schedule(self):
+        Listing.objects.filter(dol_id="H-1").update(
+            scrape_abandoned=True, scrape_attempts=8
+        )
+        Listing.objects.filter(dol_id="H-2").update(
+            next_attempt_at=timezone.now(), scrape_attempts=1
+        )
+        records = [{"case_number": f"H-{i}"} for i in range(1, 5)]
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.side_effect = self.fake_post(records)
+            call_command("sync_datahub", stdout=StringIO())
+
+        self.assertFalse(Listing.objects.filter(scrape_abandoned=True).exists())
+        self.assertFalse(Listing.objects.filter(next_attempt_at__isnull=False).exists())
+
+    def test_skips_unchanged_listings(self):
+        records = [{"case_number": f"H-{i}", "a_key": "a value"} for i in range(1, 5)]
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.side_effect = self.fake_post(records)
+            call_command("sync_datahub", stdout=StringIO())
+
+            records[0] = {"case_number": "H-1", "a_key": "new value"}
+            out = StringIO()
+            call_command("sync_datahub", stdout=out)
+            self.assertIn("Updated 1 and skipped 3 unchanged listings", out.getvalue())
+
+        self.assertEqual(
+            Listing.objects.get(dol_id="H-1").scraped_data["a_key"], "new value"
+        )
+
+    def test_stops_on_failed_page(self):
+        records = [{"case_number": f"H-{i}"} for i in range(1, 5)]
+        with patch("listings.http_client.post") as mock_request_post:
+            failed_response = FakeResponse([])
+            failed_response.status_code = 503
+            mock_request_post.side_effect = [FakeResponse(records[:2]), failed_response]
+            out = StringIO()
+            call_command("sync_datahub", stdout=out, page_size=2)
+            self.assertEqual(mock_request_post.call_count, 2)
+            self.assertIn("API call failed for page 2, status code 503", out.getvalue())
+
+        self.assertEqual(Listing.objects.filter(scraped=True).count(), 2)
+
+    def test_incremental_sync_uses_watermark(self):
+        records = [
+            {"case_number": f"H-{i}", "accepted_date": f"2021-03-0{i}T00:00:00Z"}
+            for i in range(1, 5)
+        ]
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.side_effect = self.fake_post(records)
+            call_command("sync_datahub", stdout=StringIO())
+            self.assertNotIn("filter", mock_request_post.call_args.kwargs["json"])
+        self.assertEqual(
+            StaticValue.objects.get(key=WATERMARK_KEY).value, "2021-03-04T00:00:00Z"
+        )
+
+        changed = [
+            {"case_number": "H-4", "accepted_date": "2021-03-04T00:00:00Z"},
+            {"case_number": "H-2", "accepted_date": "2021-03-05T00:00:00Z"},
+        ]
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.side_effect = self.fake_post(changed)
+            out = StringIO()
+            call_command("sync_datahub", stdout=out, incremental=True)
+            payload = mock_request_post.call_args.kwargs["json"]
+            self.assertEqual(payload["filter"], "accepted_date ge 2021-03-04T00:00:00Z")
+            self.assertTrue(payload["orderby"].startswith("accepted_date asc"))
+            self.assertIn("Updated 1 and skipped 1 unchanged listings", out.getvalue())
+        self.assertEqual(
+            StaticValue.objects.get(key=WATERMARK_KEY).value, "2021-03-05T00:00:00Z"
+        )
+
+    def test_incremental_sync_pages_by_key(self):
+        records = [
+            {"case_number": f"H-{i}", "accepted_date": f"2021-03-0{i // 2}T00:00:00Z"}
+            for i in range(1, 6)
+        ]
+        StaticValue.objects.create(key=WATERMARK_KEY, value="2021-03-01T00:00:00Z")
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.side_effect = self.fake_post(records)
+            out = StringIO()
+            call_command("sync_datahub", stdout=out, incremental=True, page_size=2)
+            self.assertEqual(mock_request_post.call_count, 3)
+            self.assertEqual(
+                mock_request_post.call_args_list[1].kwargs["json"]["filter"],
+                "accepted_date ge 2021-03-01T00:00:00Z and (accepted_date gt"
+                " 2021-03-01T00:00:00Z or (accepted_date eq 2021-03-01T00:00:00Z"
+                " and case_number gt 'H-3'))",
+            )
+            self.assertIn("Updated 3 and skipped 0 unchanged listings", out.getvalue())
+        self.assertEqual(
+            StaticValue.objects.get(key=WATERMARK_KEY).value, "2021-03-02T00:00:00Z"
+        )
+
+    def test_partial_full_sync_keeps_watermark(self):
+        records = [
+            {"case_number": f"H-{i}", "accepted_date": f"2021-03-0{i}T00:00:00Z"}
+            for i in range(1, 5)
+        ]
+        with patch("listings.http_client.post") as mock_request_post:
+            mock_request_post.side_effect = self.fake_post(records)
+            call_command("sync_datahub", stdout=StringIO(), page_size=2, max_pages=1)
+        self.assertFalse(StaticValue.objects.filter(key=WATERMARK_KEY).exists())
+
+    def test_stops_at_deadline(self):
+        records = [{"case_number": f"H-{i}"} for i in range(1, 5)]
+        with patch("listings.http_client.post") as mock_request_post, patch(
+            "listings.deadline.time", **{"monotonic.side_effect": [0, 10, 40]}
+        ):
+            mock_request_post.side_effect = self.fake_post(records)
+            out = StringIO()
+            call_command("sync_datahub", stdout=out, page_size=2, deadline=60)
+            self.assertEqual(mock_request_post.call_count, 1)
+            self.assertIn("Ran out of time after 1 pages", out.getvalue())
+        self.assertEqual(Listing.objects.filter(scraped=True).count(), 2)